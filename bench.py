@@ -0,0 +1,536 @@
+import os
+
+os.environ['DATABASE_NAME'] = os.getenv('BENCH_DATABASE_NAME', 'solttery_bench')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '1:bench')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import aiomysql
+import itertools
+import collections
+from telegram import Update
+from telegram.error import RetryAfter, TimedOut, Forbidden
+from telegram.request import BaseRequest
+
+import main
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Solttery", "username": "solttery_bench_bot"}
+SCENARIOS = ("start", "stats", "menu", "flow")
+MENU_ACTIONS = ("info", "medium_mode", "wallet", "cancel")
+SEED_BATCH = 10000
+
+class FakeRequest(BaseRequest):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            message_id = parameters.get('message_id')
+            if message_id is None:
+                self.message_id += 1
+                message_id = self.message_id
+            result = {
+                "message_id": int(message_id),
+                "date": int(time.time()),
+                "chat": {"id": int(parameters.get('chat_id', 0)), "type": "private"},
+                "from": BOT_USER,
+                "text": parameters.get('text', '')
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"bench{user_id}"}
+
+    def command(self, user_id, command):
+        self.update_id += 1
+        return Update.de_json({
+            "update_id": self.update_id,
+            "message": {
+                "message_id": self.update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": self.user(user_id),
+                "text": command,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]
+            }
+        }, self.bot)
+
+    def callback(self, user_id, data, message_id=1):
+        self.update_id += 1
+        return Update.de_json({
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": self.user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": "menu"
+                }
+            }
+        }, self.bot)
+
+class NullCursor:
+    def __init__(self):
+        self.rows = 0
+
+    async def execute(self, query, args=None):
+        self.rows += 1
+
+    async def executemany(self, query, args):
+        self.rows += len(args)
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(name, samples, elapsed):
+    if not samples:
+        print(f"{name:<8} no samples")
+        return
+    print(
+        f"{name:<8} {len(samples):>8} ops {len(samples) / elapsed:>10.1f} ops/s"
+        f"  p50 {percentile(samples, 0.5) * 1000:>8.2f} ms"
+        f"  p99 {percentile(samples, 0.99) * 1000:>8.2f} ms"
+        f"  max {max(samples) * 1000:>8.2f} ms"
+    )
+
+async def process(application, update, user_id):
+    started = time.perf_counter()
+    await application.process_update(update)
+    worker = main.dispatcher.workers.get(user_id)
+    if worker is not None:
+        await worker
+    return time.perf_counter() - started
+
+async def run_user(application, updates, scenario, user_id, iterations, samples):
+    mode = next(iter(main.GAME_MODES))
+    config = main.GAME_MODES[mode]
+    for _ in range(iterations):
+        if scenario == "start":
+            samples.append(await process(application, updates.command(user_id, "/start"), user_id))
+        elif scenario == "stats":
+            samples.append(await process(application, updates.command(user_id, "/stats"), user_id))
+        elif scenario == "menu":
+            samples.append(await process(application, updates.callback(user_id, random.choice(MENU_ACTIONS)), user_id))
+        else:
+            started = time.perf_counter()
+            await process(application, updates.callback(user_id, f'pick_{mode}'), user_id)
+            for number in random.sample(range(1, config['range'] + 1), config['numbers_to_pick']):
+                await process(application, updates.callback(user_id, f'number_{number}'), user_id)
+            await process(application, updates.callback(user_id, f'confirm_{mode}'), user_id)
+            samples.append(time.perf_counter() - started)
+
+async def reset_database():
+    conn = await aiomysql.connect(host=main.DB_HOST, user=main.DB_USER, password=main.DB_PASSWORD, autocommit=True)
+    try:
+        async with conn.cursor() as cursor:
+            await cursor.execute(f"DROP DATABASE IF EXISTS {main.DB_NAME}")
+    finally:
+        conn.close()
+
+async def use_local_data_key(uses):
+    if main.data_key_cache["plaintext"] is None:
+        main.data_key_cache.update(plaintext=os.urandom(32), encrypted=b"bench", created=time.monotonic(), uses=0)
+    main.data_key_cache["uses"] += uses
+    return main.data_key_cache["plaintext"], main.data_key_cache["encrypted"]
+
+async def process_payment(user_id, wallet_address, amount):
+    return True
+
+async def bench_handlers(args):
+    main.start_limiter = main.RateLimiter(1e9, 1e9)
+    main.callback_limiter = main.RateLimiter(1e9, 1e9)
+    main.process_payment = process_payment
+    main.PAYMENTS_ENABLED = True
+    if not main.KMS_KEY_ID:
+        main.reserve_data_key = use_local_data_key
+    if args.reset:
+        await reset_database()
+    request = FakeRequest(args.api_latency / 1000)
+    application = main.build_application(request=request)
+    await application.initialize()
+    await main.setup_database()
+    await main.init_db_pool()
+    main.outbound.start(application.bot)
+    main.dispatcher.ready.set()
+    updates = UpdateFactory(application.bot)
+    print(f"database {main.DB_NAME} on {main.DB_HOST}, concurrency {args.concurrency}, {args.iterations} iterations per user")
+    try:
+        for scenario in args.scenarios:
+            samples = []
+            users = [args.user_offset + i for i in range(args.concurrency)]
+            started = time.perf_counter()
+            await asyncio.gather(*(run_user(application, updates, scenario, user_id, args.iterations, samples) for user_id in users))
+            report(scenario, samples, time.perf_counter() - started)
+        stats = main.dispatcher.get_stats()
+        print(f"dispatcher: {stats['completed']} completed, {stats['failed']} failed, {stats['dropped']} dropped")
+        pool = main.get_db_pool_stats()
+        print(f"db pool: {pool['acquired']} acquired, avg wait {pool['wait_avg'] * 1000:.2f} ms, peak {pool['peak_in_use']} in use")
+        print("bot api: " + ", ".join(f"{endpoint} {count}" for endpoint, count in sorted(request.calls.items())))
+    finally:
+        await main.dispatcher.drain()
+        await main.outbound.stop()
+        await main.close_db_pool()
+        await application.shutdown()
+
+async def bench_draw(args):
+    mode = next(iter(main.GAME_MODES))
+    config = main.GAME_MODES[mode]
+    print(f"{'entries':>9} {'load':>10} {'resolve':>10} {'archive':>10} {'notify':>10} {'score':>10} {'winners':>8}")
+    for size in args.entries:
+        engine = main.draw_engines[mode] = main.DrawEngine(mode)
+        combos = [engine.unrank(rank) for rank in range(engine.total)]
+        tickets = [combos[random.randrange(engine.total)] for _ in range(size)]
+        winning_numbers = sorted(random.sample(range(1, config['range'] + 1), config['numbers_to_pick']))
+        started = time.perf_counter()
+        for entry_id, numbers in enumerate(tickets, 1):
+            engine.add(1, numbers, (entry_id % args.users + 1, "bench_wallet"), entry_id)
+        loaded = time.perf_counter()
+        winners = engine.winners(winning_numbers)
+        payout = engine.payout_per_winner(winning_numbers, size * config['entry_fee'] * 0.66)
+        resolved = time.perf_counter()
+        await main.archive_draw(NullCursor(), engine, 1, winning_numbers, size * config['entry_fee'], len(winners), payout)
+        archived = time.perf_counter()
+        main.outbound = main.OutboundQueue(main.SEND_RATE_LIMIT, main.SEND_CHAT_RATE_LIMIT, 0, main.SEND_MAX_ATTEMPTS, size + 1)
+        main.notify_draw(mode, 1, winning_numbers, winners, payout)
+        notified = time.perf_counter()
+        engine.score_bulk(tickets, winning_numbers)
+        scored = time.perf_counter()
+        print(
+            f"{size:>9} {(loaded - started) * 1000:>8.1f}ms {(resolved - loaded) * 1000:>8.3f}ms"
+            f" {(archived - resolved) * 1000:>8.1f}ms {(notified - archived) * 1000:>8.1f}ms"
+            f" {(scored - notified) * 1000:>8.1f}ms {len(winners):>8}"
+        )
+
+async def seed_round(cursor, mode, size, users):
+    config = main.GAME_MODES[mode]
+    round_number = (await query_one(cursor, f"SELECT draw_number FROM {main.TABLE_DRAWS} WHERE mode = %s", (mode,)))[0]
+    for offset in range(0, size, SEED_BATCH):
+        await cursor.executemany(f'''
+            INSERT INTO {main.TABLE_ENTRIES % mode} (round, user_id, wallet_address, combo)
+            VALUES (%s, %s, %s, %s)
+        ''', [
+            (round_number, entry % users + 1, "bench_wallet", main.combo_key(sorted(random.sample(range(1, config['range'] + 1), config['numbers_to_pick']))))
+            for entry in range(offset, min(size, offset + SEED_BATCH))
+        ])
+    await cursor.execute(f"UPDATE {main.TABLE_PRIZES} SET prize_pool = %s WHERE mode = %s", (size * config['entry_fee'], mode))
+    await cursor.execute(f"UPDATE {main.TABLE_DRAWS} SET next_draw_time = 0 WHERE mode = %s", (mode,))
+    return round_number
+
+async def bench_draw_db(args):
+    mode = next(iter(main.GAME_MODES))
+    if args.reset:
+        await reset_database()
+    await main.setup_database()
+    await main.init_db_pool()
+    print(f"database {main.DB_NAME} on {main.DB_HOST}")
+    print(f"{'entries':>9} {'seed':>10} {'draw':>10} {'winners':>8}")
+    try:
+        for size in args.entries:
+            async with main.db_cursor() as cursor:
+                started = time.perf_counter()
+                round_number = await seed_round(cursor, mode, size, args.users)
+                seeded = time.perf_counter()
+            main.draw_engines[mode] = main.DrawEngine(mode)
+            main.outbound = main.OutboundQueue(main.SEND_RATE_LIMIT, main.SEND_CHAT_RATE_LIMIT, 0, main.SEND_MAX_ATTEMPTS, size + 1)
+            drawing = time.perf_counter()
+            await main.draw_lottery(mode)
+            drawn = time.perf_counter()
+            async with main.db_cursor() as cursor:
+                entry_count, winner_count = await query_one(
+                    cursor,
+                    f"SELECT entry_count, winner_count FROM {main.TABLE_RESULTS} WHERE mode = %s AND round = %s",
+                    (mode, round_number)
+                )
+            expect(entry_count == size, f"round {round_number}: drew {entry_count} entries, seeded {size}")
+            print(
+                f"{size:>9} {(seeded - started) * 1000:>8.1f}ms {(drawn - drawing) * 1000:>8.1f}ms {winner_count:>8}"
+            )
+    finally:
+        await main.close_db_pool()
+
+async def run_instance(args):
+    mode = next(iter(main.GAME_MODES))
+    config = main.GAME_MODES[mode]
+    await main.init_db_pool()
+    main.lottery_stop.clear()
+    leader = asyncio.create_task(main.run_draw_leader())
+    deadline = time.monotonic() + args.duration
+    inserted = 0
+    try:
+        while time.monotonic() < deadline:
+            numbers = sorted(random.sample(range(1, config['range'] + 1), config['numbers_to_pick']))
+            await main.save_entry(mode, random.randrange(1, 1000000), "bench_wallet", numbers)
+            inserted += 1
+            await asyncio.sleep(1 / args.entry_rate)
+    finally:
+        main.lottery_stop.set()
+        await asyncio.wait([leader], timeout=main.DRAW_SHUTDOWN_TIMEOUT)
+        await main.close_db_pool()
+    print(json.dumps({"pid": os.getpid(), "entries": inserted}))
+
+async def query_one(cursor, query, args=None):
+    await cursor.execute(query, args)
+    return await cursor.fetchone()
+
+async def bench_instances(args):
+    mode = next(iter(main.GAME_MODES))
+    if args.reset:
+        await reset_database()
+    await main.setup_database()
+    conn = await aiomysql.connect(host=main.DB_HOST, user=main.DB_USER, password=main.DB_PASSWORD, db=main.DB_NAME, autocommit=True)
+    try:
+        async with conn.cursor() as cursor:
+            first_round = (await query_one(cursor, f"SELECT draw_number FROM {main.TABLE_DRAWS} WHERE mode = %s", (mode,)))[0]
+            first_id = (await query_one(cursor, f"SELECT COALESCE(MAX(id), 0) FROM {main.TABLE_ENTRIES % mode}"))[0]
+            env = dict(
+                os.environ,
+                BENCH_DATABASE_NAME=main.DB_NAME,
+                DRAW_INTERVAL=str(args.draw_interval),
+                DRAW_RETRY_DELAY='1',
+                LEADER_CHECK_INTERVAL=str(args.leader_check_interval)
+            )
+            processes = [
+                await asyncio.create_subprocess_exec(
+                    sys.executable, os.path.abspath(__file__), "instance",
+                    "--duration", str(args.duration), "--entry-rate", str(args.entry_rate),
+                    env=env, stdout=asyncio.subprocess.PIPE
+                )
+                for _ in range(args.instances)
+            ]
+            print(f"database {main.DB_NAME} on {main.DB_HOST}, {args.instances} instances, draw every {args.draw_interval}s for {args.duration}s")
+            failover_round = None
+            if args.failover:
+                await asyncio.sleep(args.duration / 2)
+                connection_id = (await query_one(cursor, "SELECT IS_USED_LOCK(%s)", (main.LEADER_LOCK_NAME,)))[0]
+                failover_round = (await query_one(cursor, f"SELECT draw_number FROM {main.TABLE_DRAWS} WHERE mode = %s", (mode,)))[0]
+                if connection_id is not None:
+                    await cursor.execute(f"KILL {int(connection_id)}")
+                    print(f"killed leader session {connection_id} at round {failover_round}")
+            outputs = await asyncio.gather(*(process.communicate() for process in processes))
+            inserted = sum(json.loads(stdout.decode().strip().splitlines()[-1])["entries"] for stdout, _ in outputs if stdout.strip())
+            last_round = (await query_one(cursor, f"SELECT draw_number FROM {main.TABLE_DRAWS} WHERE mode = %s", (mode,)))[0]
+            await cursor.execute(f"SELECT round, entry_count FROM {main.TABLE_RESULTS} WHERE mode = %s AND round >= %s", (mode, first_round))
+            results = dict(await cursor.fetchall())
+            await cursor.execute(f"SELECT round, COUNT(*) FROM {main.TABLE_ENTRIES % mode} WHERE id > %s GROUP BY round", (first_id,))
+            entries = dict(await cursor.fetchall())
+    finally:
+        conn.close()
+    problems = []
+    if sum(entries.values()) != inserted:
+        problems.append(f"{inserted} entries reported by instances, {sum(entries.values())} stored")
+    for round_number in range(first_round, last_round):
+        if round_number not in results:
+            problems.append(f"round {round_number} was never drawn")
+        elif results[round_number] != entries.get(round_number, 0):
+            problems.append(f"round {round_number} drew {results[round_number]} entries, {entries.get(round_number, 0)} were stored")
+    if failover_round is not None and last_round <= failover_round:
+        problems.append("no draw happened after the leader session was killed")
+    print(f"{last_round - first_round} rounds drawn, {inserted} entries, {len(problems)} problems")
+    for problem in problems:
+        print(f"  {problem}")
+    return 1 if problems else 0
+
+CHECK_MODES = {"check_3_20": {"numbers_to_pick": 3, "range": 20, "entry_fee": 1}, "check_5_40": {"numbers_to_pick": 5, "range": 40, "entry_fee": 1}}
+
+class FakeBot:
+    def __init__(self, failures=None):
+        self.failures = failures or {}
+        self.sent = []
+        self.attempts = collections.Counter()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.attempts[text] += 1
+        failures = self.failures.get(text, [])
+        if self.attempts[text] <= len(failures):
+            raise failures[self.attempts[text] - 1]
+        self.sent.append(text)
+
+def expect(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+def check_draw_engine():
+    numpy = main.np
+    main.GAME_MODES.update(CHECK_MODES)
+    try:
+        for mode, config in CHECK_MODES.items():
+            engine = main.DrawEngine(mode)
+            seen = set()
+            for numbers in itertools.combinations(range(1, config['range'] + 1), config['numbers_to_pick']):
+                rank = engine.rank(numbers)
+                expect(0 <= rank < engine.total and rank not in seen, f"{mode}: rank({numbers}) = {rank}")
+                expect(engine.unrank(rank) == list(numbers), f"{mode}: unrank({rank}) != {numbers}")
+                seen.add(rank)
+            expect(len(seen) == engine.total, f"{mode}: {len(seen)} of {engine.total} ranks covered")
+            for invalid in ([0] + list(range(2, config['numbers_to_pick'] + 1)), [1] * config['numbers_to_pick'], list(range(1, config['numbers_to_pick'])), [config['range'] + 1] + list(range(1, config['numbers_to_pick']))):
+                try:
+                    engine.rank(invalid)
+                except ValueError:
+                    continue
+                raise AssertionError(f"{mode}: rank({invalid}) did not raise")
+            paths = [("python", None)] + ([("numpy", numpy)] if numpy is not None else [])
+            results = {}
+            for name, module in paths:
+                main.np = module
+                tickets = engine.random_tickets(500)
+                ranks = [engine.rank(numbers) for numbers in tickets]
+                expect(len(set(ranks)) == 500, f"{mode}/{name}: random_tickets returned duplicates")
+                expect(all(sorted(numbers) == list(numbers) for numbers in tickets), f"{mode}/{name}: random_tickets not sorted")
+                fixed = [engine.unrank(rank) for rank in range(0, engine.total, max(1, engine.total // 997))]
+                fixed += fixed[:50]
+                counts, winners = engine.score_bulk(fixed, fixed[3])
+                results[name] = ([int(rank) for rank in engine.rank_many(fixed)], [int(count) for count in counts], [int(index) for index in winners])
+                expect(results[name][0] == [engine.rank(numbers) for numbers in fixed], f"{mode}/{name}: rank_many mismatch")
+                expect(results[name][2] == [3, len(fixed) - 50 + 3], f"{mode}/{name}: score_bulk winners {results[name][2]}")
+                expect(sum(results[name][1]) == len(fixed), f"{mode}/{name}: score_bulk counts")
+            expect(len({repr(result) for result in results.values()}) == 1, f"{mode}: numpy and python paths disagree")
+            print(f"ok draw engine {mode} ({' + '.join(results)})")
+    finally:
+        main.np = numpy
+        for mode in CHECK_MODES:
+            main.GAME_MODES.pop(mode, None)
+    engine = main.DrawEngine(next(iter(main.GAME_MODES)))
+    for entry_id in (1, 3, 5, 7, 9):
+        engine.add(1, [1, 2, 3], (entry_id, "w"), entry_id)
+    expect((engine.synced_id, engine.pending_ids, engine.entry_count) == (1, {3, 5, 7, 9}, 5), "watermark after gaps")
+    expect(engine.add(1, [1, 2, 3], (3, "w"), 3) is None and engine.entry_count == 5, "duplicate entry counted")
+    engine.add(2, [1, 2, 4], (11, "w"), 11)
+    expect((engine.round, engine.pending_ids, engine.entry_count) == (2, {11}, 1), "round change keeps stale pending ids")
+    engine.advance_synced(20)
+    expect(engine.pending_ids == set() and engine.synced_id == 20, "advance_synced")
+    print("ok draw engine watermark")
+
+def check_rate_limiter():
+    limiter = main.RateLimiter(1, 2, max_keys=3, ttl=60)
+    expect(limiter.hit("a") == (0.0, False) and limiter.hit("a") == (0.0, False), "burst not allowed")
+    retry_after, notify = limiter.hit("a")
+    expect(retry_after > 0 and notify, "first throttled hit should notify")
+    expect(limiter.hit("a")[1] is False, "second throttled hit should not notify")
+    for key in "bcd":
+        limiter.hit(key)
+    expect(list(limiter.entries) == ["b", "c", "d"], f"LRU eviction kept {list(limiter.entries)}")
+    limiter.entries["b"][0].updated -= 120
+    limiter.hit("c")
+    expect(list(limiter.entries) == ["d", "c"], f"TTL eviction kept {list(limiter.entries)}")
+    print("ok rate limiter")
+
+async def check_outbound_queue():
+    bot = FakeBot({"flaky": [TimedOut()], "throttled": [RetryAfter(1)], "blocked": [Forbidden("blocked")], "dead": [TimedOut()] * 5})
+    queue = main.OutboundQueue(1000, 1000, 1, 2, 100)
+    for text in ("broadcast 1", "broadcast 2"):
+        queue.send(-100, text)
+    for chat_id, text in enumerate(("winner 1", "winner 2"), 1):
+        queue.send(chat_id, text, priority=main.SEND_PRIORITY_WINNER)
+    for chat_id, text in enumerate(("flaky", "throttled", "blocked", "dead"), 3):
+        queue.send(chat_id, text)
+    queue.start(bot)
+    started = time.monotonic()
+    await queue.stop(timeout=30)
+    stats = queue.get_stats()
+    expect(bot.sent[:2] == ["winner 1", "winner 2"], f"winners not sent first: {bot.sent}")
+    expect(sorted(bot.sent) == ["broadcast 1", "broadcast 2", "flaky", "throttled", "winner 1", "winner 2"], f"sent {bot.sent}")
+    expect(bot.attempts["dead"] == 2 and bot.attempts["blocked"] == 1, f"attempts {dict(bot.attempts)}")
+    expect((stats["sent"], stats["failed"], stats["rate_limited"], stats["queued"]) == (6, 2, 1, 0), f"stats {stats}")
+    expect(time.monotonic() - started >= 1, "RetryAfter did not pause sending")
+    print("ok outbound queue")
+
+async def check_wallet_encryption():
+    if not (main.KMS_KEY_ID and os.getenv('KMS_ENDPOINT_URL')):
+        print("skip wallet encryption (set KMS_KEY_ID and KMS_ENDPOINT_URL to a local KMS stand-in)")
+        return
+    wallets = await main.create_wallets(3)
+    _, encoded_data_key, nonce, ciphertext = wallets[0][1].split(':')
+    expect(len({encrypted.split(':')[1] for _, encrypted in wallets}) == 1, "data key not reused across a batch")
+    data_key = (await asyncio.to_thread(main.kms_client.decrypt, CiphertextBlob=main.base64.b64decode(encoded_data_key)))['Plaintext']
+    secret = main.AESGCM(data_key).decrypt(main.base64.b64decode(nonce), main.base64.b64decode(ciphertext), None)
+    expect(str(main.Keypair.from_bytes(secret).pubkey()) == wallets[0][0], "decrypted key does not match the wallet address")
+    print("ok wallet encryption")
+
+async def run_checks(args):
+    check_draw_engine()
+    check_rate_limiter()
+    await check_outbound_queue()
+    await check_wallet_encryption()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Solttery bot")
+    commands = parser.add_subparsers(dest="command", required=True)
+    handlers = commands.add_parser("handlers", help="drive handlers end to end against a fake Bot API and a local MySQL-compatible server")
+    handlers.add_argument("--concurrency", type=int, default=50)
+    handlers.add_argument("--iterations", type=int, default=20)
+    handlers.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    handlers.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency in milliseconds")
+    handlers.add_argument("--user-offset", type=int, default=1000000)
+    handlers.add_argument("--reset", action="store_true", help="drop the benchmark database before running")
+    draw = commands.add_parser("draw", help="time draw resolution in memory")
+    draw.add_argument("--entries", type=int, nargs="+", default=[10000, 100000, 1000000])
+    draw.add_argument("--users", type=int, default=10000)
+    draw_db = commands.add_parser("draw-db", help="seed a round in a local MySQL-compatible server and time draw_lottery end to end with a cold draw engine")
+    draw_db.add_argument("--entries", type=int, nargs="+", default=[10000, 100000, 1000000])
+    draw_db.add_argument("--users", type=int, default=10000)
+    draw_db.add_argument("--reset", action="store_true", help="drop the benchmark database before running")
+    instances = commands.add_parser("instances", help="run several bot instances against one MySQL-compatible server and check every round is drawn once with all its entries")
+    instances.add_argument("--instances", type=int, default=3)
+    instances.add_argument("--duration", type=float, default=30)
+    instances.add_argument("--draw-interval", type=int, default=2)
+    instances.add_argument("--leader-check-interval", type=float, default=1)
+    instances.add_argument("--entry-rate", type=float, default=20, help="entries per second per instance")
+    instances.add_argument("--no-failover", dest="failover", action="store_false", help="do not kill the leader's lock session halfway through")
+    instances.add_argument("--reset", action="store_true", help="drop the benchmark database before running")
+    commands.add_parser("check", help="run deterministic checks of the draw engine, rate limiter, send queue and wallet encryption")
+    instance = commands.add_parser("instance")
+    instance.add_argument("--duration", type=float, required=True)
+    instance.add_argument("--entry-rate", type=float, required=True)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == "handlers":
+        asyncio.run(bench_handlers(args))
+    elif args.command == "draw":
+        asyncio.run(bench_draw(args))
+    elif args.command == "draw-db":
+        asyncio.run(bench_draw_db(args))
+    elif args.command == "check":
+        asyncio.run(run_checks(args))
+    elif args.command == "instances":
+        sys.exit(asyncio.run(bench_instances(args)))
+    else:
+        asyncio.run(run_instance(args))
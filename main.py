@@ -3,26 +3,36 @@ import math
 import time
 import boto3
 import base58
+import base64
 import random
 import asyncio
 import logging
 import aiomysql
 import warnings
-import threading
 import json
 import aiofiles
 import datetime
+import contextlib
+import functools
+import heapq
+import bisect
+import collections
 import pymysql.cursors
+try:
+    import numpy as np
+except ImportError:
+    np = None
 from dotenv import load_dotenv
 from solders.keypair import Keypair
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import telegram
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Bot
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, CallbackContext, ContextTypes
-from telegram.error import TimedOut, BadRequest
+from telegram.error import TimedOut, BadRequest, RetryAfter, NetworkError, Forbidden
 
 warnings.simplefilter("ignore")
 load_dotenv()
-logging.basicConfig(level=logging.ERROR)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'ERROR').upper())
 
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 DB_NAME = os.getenv('DATABASE_NAME')
@@ -30,31 +40,572 @@ DB_HOST = os.getenv('DATABASE_HOST')
 DB_USER = os.getenv('DATABASE_USER')
 DB_PASSWORD = os.getenv('DATABASE_PASSWORD')
 CHANNELID = int(os.getenv('TELEGRAM_CHANNEL_ID', '0'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', '32'))
 TABLE_USERS = os.getenv('TABLE_USERS', 'tbl_users')
 TABLE_LOTTERY = os.getenv('TABLE_LOTTERY', 'tbl_lottery_%s')
 TABLE_PRIZES = os.getenv('TABLE_PRIZES', 'tbl_prizes')
+TABLE_ENTRIES = os.getenv('TABLE_ENTRIES', 'tbl_entries_%s')
+TABLE_DRAWS = os.getenv('TABLE_DRAWS', 'tbl_draws')
+TABLE_FREE_ENTRIES = os.getenv('TABLE_FREE_ENTRIES', 'tbl_free_entries')
+TABLE_USER_STATE = os.getenv('TABLE_USER_STATE', 'tbl_user_state')
+TABLE_BULK_ORDERS = os.getenv('TABLE_BULK_ORDERS', 'tbl_bulk_orders')
+TABLE_WALLET_POOL = os.getenv('TABLE_WALLET_POOL', 'tbl_wallet_pool')
+TABLE_RESULTS = os.getenv('TABLE_RESULTS', 'tbl_draw_results')
+TABLE_NUMBER_STATS = os.getenv('TABLE_NUMBER_STATS', 'tbl_number_stats')
+TABLE_COMBO_STATS = os.getenv('TABLE_COMBO_STATS', 'tbl_combo_stats')
+KMS_KEY_ID = os.getenv('KMS_KEY_ID')
+WALLET_POOL_TARGET = int(os.getenv('WALLET_POOL_TARGET', '200'))
+WALLET_POOL_LOW = int(os.getenv('WALLET_POOL_LOW', '50'))
+WALLET_POOL_BATCH = int(os.getenv('WALLET_POOL_BATCH', '50'))
+WALLET_POOL_CHECK_INTERVAL = float(os.getenv('WALLET_POOL_CHECK_INTERVAL', '60'))
+DATA_KEY_MAX_AGE = float(os.getenv('DATA_KEY_MAX_AGE', '3600'))
+DATA_KEY_MAX_USES = int(os.getenv('DATA_KEY_MAX_USES', '10000'))
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '0' if BOT_MODE == 'webhook' else '10000'))
+PAYMENTS_ENABLED = os.getenv('PAYMENTS_ENABLED', 'false').lower() == 'true'
+BULK_TICKET_OPTIONS = [int(n) for n in os.getenv('BULK_TICKET_OPTIONS', '10,25,50,100').split(',')]
+DB_POOL_MINSIZE = int(os.getenv('DATABASE_POOL_MINSIZE', '1'))
+DB_POOL_MAXSIZE = int(os.getenv('DATABASE_POOL_MAXSIZE', '10'))
+DB_POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', '3600'))
 bot = Bot(token=TOKEN)
 
 kms_client = boto3.client(
     'kms',
     region_name=os.getenv('AWS_REGION'),
     aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
+    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+    endpoint_url=os.getenv('KMS_ENDPOINT_URL')
 )
 
-user_last_start_time = {}
 START_COMMAND_COOLDOWN = 3
-MAX_START_COMMAND_COOLDOWN = 30
-user_spam_count = {}
-user_notified = {}
+CALLBACK_RATE_LIMIT = float(os.getenv('CALLBACK_RATE_LIMIT', '2'))
+CALLBACK_RATE_BURST = int(os.getenv('CALLBACK_RATE_BURST', '5'))
+RATE_LIMIT_MAX_USERS = int(os.getenv('RATE_LIMIT_MAX_USERS', '100000'))
+RATE_LIMIT_TTL = float(os.getenv('RATE_LIMIT_TTL', '600'))
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', '64'))
+DISPATCH_USER_QUEUE = int(os.getenv('DISPATCH_USER_QUEUE', '5'))
+DISPATCH_DRAIN_TIMEOUT = float(os.getenv('DISPATCH_DRAIN_TIMEOUT', '10'))
+SEND_RATE_LIMIT = float(os.getenv('SEND_RATE_LIMIT', '25'))
+SEND_CHAT_RATE_LIMIT = float(os.getenv('SEND_CHAT_RATE_LIMIT', '1'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '8'))
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', '5'))
+SEND_QUEUE_SIZE = int(os.getenv('SEND_QUEUE_SIZE', '100000'))
+SEND_DRAIN_TIMEOUT = float(os.getenv('SEND_DRAIN_TIMEOUT', '10'))
+SEND_PRIORITY_WINNER = 0
+SEND_PRIORITY_BROADCAST = 1
 FREE_ENTRIES_FILE = "free_entries.json"
 DRAW_INFO_FILE = "draw_info.json"
 TOTAL_FREE_ENTRIES = 200
+ROUND_CACHE_TTL = float(os.getenv('ROUND_CACHE_TTL', '30'))
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', '60'))
+DRAW_INTERVAL = int(os.getenv('DRAW_INTERVAL', '3600'))
+DRAW_RETRY_DELAY = float(os.getenv('DRAW_RETRY_DELAY', '30'))
+DRAW_SHUTDOWN_TIMEOUT = float(os.getenv('DRAW_SHUTDOWN_TIMEOUT', '30'))
+LEADER_LOCK_NAME = os.getenv('LEADER_LOCK_NAME', 'solttery_draw_leader')
+WALLET_POOL_LOCK_NAME = os.getenv('WALLET_POOL_LOCK_NAME', 'solttery_wallet_pool')
+LEADER_CHECK_INTERVAL = float(os.getenv('LEADER_CHECK_INTERVAL', '5'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_BUTTON_ACTIONS = frozenset(("info", "medium", "bulk", "bulkbuy", "bulkconfirm", "pick", "random", "number", "confirm", "cancel", "wallet", "secret"))
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
 GAME_MODES = {
     "medium": {"numbers_to_pick": 3, "range": 20, "entry_fee": 25000}
 }
 
+db_pool = None
+db_pool_stats = {"acquired": 0, "in_use": 0, "peak_in_use": 0, "wait_total": 0.0, "wait_max": 0.0}
+lottery_tasks = []
+lottery_stop = asyncio.Event()
+is_draw_leader = False
+wallet_tasks = []
+wallet_pool_refill = asyncio.Event()
+data_key_lock = asyncio.Lock()
+data_key_cache = {"plaintext": None, "encrypted": None, "created": 0.0, "uses": 0}
+profile_cache = collections.OrderedDict()
+rendered_views = collections.OrderedDict()
+round_state_cache = {}
+free_entries_cache = {"remaining": None, "loaded_at": 0.0}
+stats_cache = {}
+metrics_server = None
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}
+        self.gauge_groups = {}
+        self.in_flight = collections.defaultdict(int)
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+
+    def gauge(self, name, collect, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = collect
+
+    def gauge_group(self, prefix, collect):
+        self.gauge_groups[prefix] = collect
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @contextlib.contextmanager
+    def span(self, handler, update=None, **labels):
+        started = time.perf_counter()
+        status = "ok"
+        self.in_flight[handler] += 1
+        try:
+            yield
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            self.in_flight[handler] -= 1
+            self.observe("solttery_handler_duration_seconds", duration, handler=handler, **labels)
+            self.inc("solttery_handler_calls_total", handler=handler, status=status, **labels)
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info(json.dumps({
+                    "event": "update",
+                    "handler": handler,
+                    "update_id": update.update_id if update else None,
+                    "user_id": update.effective_user.id if update and update.effective_user else None,
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 3),
+                    **labels
+                }))
+
+    def render(self):
+        lines = []
+        typed = set()
+        def line(name, kind, labels, value, suffix=""):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+        for (name, labels), value in sorted(self.counters.items()):
+            line(name, "counter", labels, value)
+        for (name, labels), (counts, total) in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                line(name, "histogram", labels + (("le", bound),), cumulative, "_bucket")
+            line(name, "histogram", labels, total, "_sum")
+            line(name, "histogram", labels, cumulative, "_count")
+        for handler, value in sorted(self.in_flight.items()):
+            line("solttery_handler_in_flight", "gauge", (("handler", handler),), value)
+        for (name, labels), collect in sorted(self.gauges.items(), key=lambda item: item[0]):
+            line(name, "gauge", labels, collect())
+        for prefix, collect in self.gauge_groups.items():
+            for key, value in collect().items():
+                if isinstance(value, (int, float)):
+                    line(f"{prefix}_{key}", "gauge", (), value)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRICS_BUCKETS)
+
+class TimedCursor(aiomysql.Cursor):
+    async def execute(self, query, args=None):
+        with metrics.timer("solttery_db_query_seconds", statement=query.split(None, 1)[0].upper()):
+            return await super().execute(query, args)
+
+async def init_db_pool():
+    global db_pool
+    if db_pool is None:
+        db_pool = await aiomysql.create_pool(
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            db=DB_NAME,
+            autocommit=True,
+            minsize=DB_POOL_MINSIZE,
+            maxsize=DB_POOL_MAXSIZE,
+            pool_recycle=DB_POOL_RECYCLE,
+            cursorclass=TimedCursor
+        )
+    return db_pool
+
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        db_pool.close()
+        await db_pool.wait_closed()
+        db_pool = None
+
+@contextlib.asynccontextmanager
+async def db_connection():
+    started = time.perf_counter()
+    async with db_pool.acquire() as conn:
+        waited = time.perf_counter() - started
+        db_pool_stats["acquired"] += 1
+        db_pool_stats["wait_total"] += waited
+        db_pool_stats["wait_max"] = max(db_pool_stats["wait_max"], waited)
+        metrics.observe("solttery_db_pool_wait_seconds", waited)
+        db_pool_stats["in_use"] += 1
+        db_pool_stats["peak_in_use"] = max(db_pool_stats["peak_in_use"], db_pool_stats["in_use"])
+        try:
+            yield conn
+        finally:
+            db_pool_stats["in_use"] -= 1
+
+@contextlib.asynccontextmanager
+async def db_cursor():
+    async with db_connection() as conn:
+        async with conn.cursor() as cursor:
+            yield cursor
+
+def get_db_pool_stats():
+    stats = dict(db_pool_stats)
+    stats["wait_avg"] = stats["wait_total"] / stats["acquired"] if stats["acquired"] else 0.0
+    if db_pool is not None:
+        stats.update(size=db_pool.size, free=db_pool.freesize, minsize=db_pool.minsize, maxsize=db_pool.maxsize)
+    return stats
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+class RateLimiter:
+    def __init__(self, rate, capacity, max_keys=RATE_LIMIT_MAX_USERS, ttl=RATE_LIMIT_TTL):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def evict(self):
+        expires = time.monotonic() - self.ttl
+        while self.entries:
+            bucket, _ = next(iter(self.entries.values()))
+            if bucket.updated >= expires and len(self.entries) <= self.max_keys:
+                break
+            self.entries.popitem(last=False)
+
+    def hit(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [TokenBucket(self.rate, self.capacity), False]
+        else:
+            self.entries.move_to_end(key)
+        retry_after = entry[0].consume()
+        self.evict()
+        if retry_after == 0:
+            entry[1] = False
+            return 0.0, False
+        notify = not entry[1]
+        entry[1] = True
+        return retry_after, notify
+
+start_limiter = RateLimiter(1 / START_COMMAND_COOLDOWN, 1)
+callback_limiter = RateLimiter(CALLBACK_RATE_LIMIT, CALLBACK_RATE_BURST)
+
+class UpdateDispatcher:
+    def __init__(self, concurrency, user_queue_size):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.user_queue_size = user_queue_size
+        self.queues = {}
+        self.workers = {}
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "dropped": 0, "queued": 0, "running": 0}
+
+    def submit(self, user_id, job):
+        if self.closed:
+            self.stats["dropped"] += 1
+            return False
+        queue = self.queues.setdefault(user_id, collections.deque())
+        if len(queue) >= self.user_queue_size:
+            self.stats["dropped"] += 1
+            return False
+        queue.append((job, time.perf_counter()))
+        self.stats["submitted"] += 1
+        self.stats["queued"] += 1
+        if user_id not in self.workers:
+            self.workers[user_id] = asyncio.create_task(self.run_user(user_id))
+        return True
+
+    async def run_user(self, user_id):
+        queue = self.queues[user_id]
+        try:
+            await self.ready.wait()
+            while queue:
+                job, submitted_at = queue.popleft()
+                self.stats["queued"] -= 1
+                async with self.semaphore:
+                    metrics.observe("solttery_dispatch_wait_seconds", time.perf_counter() - submitted_at)
+                    self.stats["running"] += 1
+                    try:
+                        await job()
+                        self.stats["completed"] += 1
+                    except Exception:
+                        self.stats["failed"] += 1
+                        logging.exception("Update handler failed for user %s", user_id)
+                    finally:
+                        self.stats["running"] -= 1
+        finally:
+            self.stats["queued"] -= len(queue)
+            self.stats["dropped"] += len(queue)
+            del self.queues[user_id]
+            del self.workers[user_id]
+
+    def get_stats(self):
+        return dict(self.stats, users=len(self.workers))
+
+    async def drain(self, timeout=DISPATCH_DRAIN_TIMEOUT):
+        self.closed = True
+        workers = list(self.workers.values())
+        if not workers:
+            return
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+dispatcher = UpdateDispatcher(DISPATCH_CONCURRENCY, DISPATCH_USER_QUEUE)
+
+class OutboundQueue:
+    def __init__(self, rate, chat_rate, workers, max_attempts, max_size):
+        self.global_bucket = TokenBucket(rate, max(rate, 1))
+        self.chat_limiter = RateLimiter(chat_rate, 1)
+        self.worker_count = workers
+        self.max_attempts = max_attempts
+        self.max_size = max_size
+        self.queue = asyncio.PriorityQueue()
+        self.workers = []
+        self.timers = set()
+        self.sequence = 0
+        self.paused_until = 0.0
+        self.bot = None
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.stats = {"enqueued": 0, "sent": 0, "failed": 0, "dropped": 0, "retried": 0, "rate_limited": 0, "queued": 0, "delivery_total": 0.0, "delivery_max": 0.0}
+
+    def start(self, bot):
+        self.bot = bot
+        self.workers = [asyncio.create_task(self.run()) for _ in range(self.worker_count)]
+
+    def send(self, chat_id, text, priority=SEND_PRIORITY_BROADCAST, **kwargs):
+        if self.stats["queued"] >= self.max_size:
+            self.stats["dropped"] += 1
+            return False
+        self.sequence += 1
+        self.stats["enqueued"] += 1
+        self.stats["queued"] += 1
+        self.idle.clear()
+        self.queue.put_nowait((priority, self.sequence, chat_id, text, kwargs, 1, time.monotonic()))
+        return True
+
+    def requeue(self, item, delay):
+        def put():
+            self.timers.discard(timer)
+            self.queue.put_nowait(item)
+        timer = asyncio.get_running_loop().call_later(delay, put)
+        self.timers.add(timer)
+
+    def finish(self, outcome, enqueued_at=None):
+        self.stats[outcome] += 1
+        self.stats["queued"] -= 1
+        if enqueued_at is not None:
+            latency = time.monotonic() - enqueued_at
+            self.stats["delivery_total"] += latency
+            self.stats["delivery_max"] = max(self.stats["delivery_max"], latency)
+        if self.stats["queued"] == 0:
+            self.idle.set()
+
+    async def run(self):
+        while True:
+            item = await self.queue.get()
+            priority, sequence, chat_id, text, kwargs, attempt, enqueued_at = item
+            retry_after, _ = self.chat_limiter.hit(chat_id)
+            if retry_after:
+                self.requeue(item, retry_after)
+                continue
+            while True:
+                delay = max(self.paused_until - time.monotonic(), self.global_bucket.consume())
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.finish("sent", enqueued_at)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else e.retry_after
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                self.stats["rate_limited"] += 1
+                self.retry(item, retry_after)
+            except (BadRequest, Forbidden) as e:
+                logging.error("Dropping message to %s: %s", chat_id, e)
+                self.finish("failed")
+            except (TimedOut, NetworkError):
+                self.retry(item, min(2 ** attempt, 30))
+            except Exception:
+                logging.exception("Failed to send message to %s", chat_id)
+                self.finish("failed")
+
+    def retry(self, item, delay):
+        priority, sequence, chat_id, text, kwargs, attempt, enqueued_at = item
+        if attempt >= self.max_attempts:
+            logging.error("Giving up on message to %s after %s attempts", chat_id, attempt)
+            self.finish("failed")
+            return
+        self.stats["retried"] += 1
+        self.requeue((priority, sequence, chat_id, text, kwargs, attempt + 1, enqueued_at), delay)
+
+    def get_stats(self):
+        stats = dict(self.stats, waiting=self.queue.qsize(), delayed=len(self.timers))
+        stats["delivery_avg"] = stats["delivery_total"] / stats["sent"] if stats["sent"] else 0.0
+        return stats
+
+    async def stop(self, timeout=SEND_DRAIN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.error("Dropping %s undelivered messages", self.stats["queued"])
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+outbound = OutboundQueue(SEND_RATE_LIMIT, SEND_CHAT_RATE_LIMIT, SEND_WORKERS, SEND_MAX_ATTEMPTS, SEND_QUEUE_SIZE)
+
+class DrawEngine:
+    def __init__(self, mode):
+        config = GAME_MODES[mode]
+        self.mode = mode
+        self.pick = config['numbers_to_pick']
+        self.range = config['range']
+        self.total = math.comb(self.range, self.pick)
+        self.binomials = [[math.comb(a, i) for i in range(self.pick + 1)] for a in range(self.range + 1)]
+        self.synced_id = 0
+        self.pending_ids = set()
+        self.reset(None)
+
+    def reset(self, round_number):
+        self.round = round_number
+        self.counts = {}
+        self.holders = {}
+        self.entry_count = 0
+        self.pending_ids.clear()
+
+    def rank(self, numbers):
+        numbers = sorted(numbers)
+        if len(numbers) != self.pick or len(set(numbers)) != self.pick or numbers[0] < 1 or numbers[-1] > self.range:
+            raise ValueError(f"Invalid {self.mode} ticket: {numbers}")
+        return sum(self.binomials[n - 1][i + 1] for i, n in enumerate(numbers))
+
+    def unrank(self, rank):
+        numbers = []
+        for i in range(self.pick, 0, -1):
+            a = i - 1
+            while a + 1 < self.range and self.binomials[a + 1][i] <= rank:
+                a += 1
+            rank -= self.binomials[a][i]
+            numbers.append(a + 1)
+        return numbers[::-1]
+
+    def advance_synced(self, entry_id):
+        self.synced_id = max(self.synced_id, entry_id)
+        self.pending_ids = {i for i in self.pending_ids if i > self.synced_id}
+
+    def add(self, round_number, numbers, holder, entry_id=None):
+        if entry_id is not None and (entry_id <= self.synced_id or entry_id in self.pending_ids):
+            return None
+        if self.round is None or round_number > self.round:
+            self.reset(round_number)
+        elif round_number < self.round:
+            return None
+        if entry_id is not None:
+            self.pending_ids.add(entry_id)
+            while self.synced_id + 1 in self.pending_ids:
+                self.synced_id += 1
+                self.pending_ids.discard(self.synced_id)
+        rank = self.rank(numbers)
+        self.counts[rank] = self.counts.get(rank, 0) + 1
+        self.holders.setdefault(rank, []).append(holder)
+        self.entry_count += 1
+        return rank
+
+    def winners(self, winning_numbers):
+        return self.holders.get(self.rank(winning_numbers), [])
+
+    def payout_per_winner(self, winning_numbers, winnable_amount):
+        winner_count = self.counts.get(self.rank(winning_numbers), 0)
+        return winnable_amount / winner_count if winner_count else 0
+
+    def rank_many(self, tickets):
+        if np is None:
+            return [self.rank(numbers) for numbers in tickets]
+        tickets = np.sort(np.asarray(tickets, dtype=np.int64).reshape(-1, self.pick), axis=1)
+        binomials = np.asarray(self.binomials, dtype=np.int64)
+        return binomials[tickets - 1, np.arange(1, self.pick + 1)].sum(axis=1)
+
+    def random_tickets(self, count):
+        if count > self.total:
+            raise ValueError(f"Only {self.total} distinct {self.mode} tickets exist")
+        if np is None:
+            return [self.unrank(rank) for rank in random.sample(range(self.total), count)]
+        ranks = np.random.default_rng().choice(self.total, size=count, replace=False).astype(np.int64)
+        binomials = np.asarray(self.binomials, dtype=np.int64)
+        tickets = np.empty((count, self.pick), dtype=np.int64)
+        for i in range(self.pick, 0, -1):
+            a = np.searchsorted(binomials[:, i], ranks, side='right') - 1
+            ranks -= binomials[a, i]
+            tickets[:, i - 1] = a + 1
+        return tickets.tolist()
+
+    def score_bulk(self, tickets, winning_numbers):
+        winning_rank = self.rank(winning_numbers)
+        ranks = self.rank_many(tickets)
+        if np is None:
+            counts = [0] * self.total
+            for rank in ranks:
+                counts[rank] += 1
+            return counts, [i for i, rank in enumerate(ranks) if rank == winning_rank]
+        counts = np.bincount(ranks, minlength=self.total)
+        return counts, np.flatnonzero(ranks == winning_rank)
+
+draw_engines = {mode: DrawEngine(mode) for mode in GAME_MODES}
+
 async def setup_database():
     pool = await aiomysql.create_pool(
         host=DB_HOST,
@@ -68,6 +619,90 @@ async def setup_database():
             await cursor.execute(f"USE {DB_NAME}")
             await cursor.execute(f"GRANT ALL PRIVILEGES ON {DB_NAME}.* TO '{DB_USER}'@'%'")
             await cursor.execute("FLUSH PRIVILEGES")
+            legacy_draw_info, legacy_free_entries = await asyncio.to_thread(read_legacy_state)
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_DRAWS} (
+                    mode VARCHAR(10) PRIMARY KEY,
+                    draw_number INT NOT NULL DEFAULT 1,
+                    next_draw_time DOUBLE NULL
+                )
+            ''')
+            for mode in GAME_MODES:
+                draw_info = legacy_draw_info.get(mode, {})
+                await cursor.execute(f'''
+                    INSERT IGNORE INTO {TABLE_DRAWS} (mode, draw_number, next_draw_time)
+                    VALUES (%s, %s, %s)
+                ''', (mode, draw_info.get("draw_number", 1), draw_info.get("next_draw_time")))
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_FREE_ENTRIES} (
+                    id TINYINT PRIMARY KEY,
+                    remaining INT NOT NULL
+                )
+            ''')
+            await cursor.execute(f'''
+                INSERT IGNORE INTO {TABLE_FREE_ENTRIES} (id, remaining)
+                VALUES (1, %s)
+            ''', (legacy_free_entries,))
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_USER_STATE} (
+                    user_id BIGINT PRIMARY KEY,
+                    mode VARCHAR(10) NOT NULL,
+                    numbers VARCHAR(255) NOT NULL DEFAULT '',
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                )
+            ''')
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_BULK_ORDERS} (
+                    user_id BIGINT PRIMARY KEY,
+                    mode VARCHAR(10) NOT NULL,
+                    ticket_count INT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                )
+            ''')
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_RESULTS} (
+                    mode VARCHAR(10) NOT NULL,
+                    round INT NOT NULL,
+                    winning_combo VARCHAR(255) NOT NULL,
+                    entry_count INT NOT NULL,
+                    winner_count INT NOT NULL,
+                    prize_pool DOUBLE NOT NULL,
+                    payout_per_winner DOUBLE NOT NULL,
+                    drawn_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (mode, round)
+                )
+            ''')
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_NUMBER_STATS} (
+                    mode VARCHAR(10) NOT NULL,
+                    number INT NOT NULL,
+                    times_drawn INT NOT NULL DEFAULT 0,
+                    times_played BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (mode, number)
+                )
+            ''')
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_COMBO_STATS} (
+                    mode VARCHAR(10) NOT NULL,
+                    combo VARCHAR(255) NOT NULL,
+                    times_played BIGINT NOT NULL DEFAULT 0,
+                    PRIMARY KEY (mode, combo),
+                    INDEX idx_mode_played (mode, times_played)
+                )
+            ''')
+            for mode, config in GAME_MODES.items():
+                await cursor.executemany(f'''
+                    INSERT IGNORE INTO {TABLE_NUMBER_STATS} (mode, number)
+                    VALUES (%s, %s)
+                ''', [(mode, number) for number in range(1, config['range'] + 1)])
+            await cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {TABLE_WALLET_POOL} (
+                    id BIGINT PRIMARY KEY AUTO_INCREMENT,
+                    wallet_address VARCHAR(64) NOT NULL,
+                    encrypted_private_key TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
             await cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS {TABLE_USERS} (
                     user_id BIGINT PRIMARY KEY,
@@ -87,6 +722,20 @@ async def setup_database():
                         entries JSON
                     )
                 ''')
+                await cursor.execute(f'''
+                    CREATE TABLE IF NOT EXISTS {TABLE_ENTRIES % mode} (
+                        id BIGINT PRIMARY KEY AUTO_INCREMENT,
+                        round INT NOT NULL,
+                        user_id BIGINT NULL,
+                        wallet_address VARCHAR(64) NOT NULL,
+                        combo VARCHAR(255) NOT NULL,
+                        free_entry TINYINT NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        INDEX idx_round_combo (round, combo),
+                        INDEX idx_round_user (round, user_id)
+                    )
+                ''')
+                await migrate_json_entries(conn, cursor, mode)
             await cursor.execute(f'''
                 CREATE TABLE IF NOT EXISTS {TABLE_PRIZES} (
                     mode VARCHAR(10) PRIMARY KEY,
@@ -103,43 +752,347 @@ async def setup_database():
                     ''', (mode, 0))
     pool.close()
     await pool.wait_closed()
-    tasks = [monitor_lottery(mode) for mode in GAME_MODES]
-    await asyncio.gather(*tasks)
 
-async def load_remaining_free_entries():
+def combo_key(numbers):
+    return ','.join(map(str, sorted(numbers)))
+
+def release_draw_engines():
+    for engine in draw_engines.values():
+        engine.synced_id = 0
+        engine.reset(None)
+
+def parse_combo(combo):
+    return [int(n) for n in combo.split(',')]
+
+def is_valid_ticket(mode, numbers):
+    try:
+        draw_engines[mode].rank(numbers)
+    except (KeyError, ValueError):
+        return False
+    return True
+
+def add_stored_entry(engine, round_number, entry_id, user_id, wallet_address, combo):
+    try:
+        engine.add(round_number, parse_combo(combo), (user_id, wallet_address), entry_id)
+    except ValueError:
+        logging.error("Skipping invalid %s entry %s: %s", engine.mode, entry_id, combo)
+
+async def load_draw_engine(mode, cursor=None):
+    if cursor is None:
+        async with db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await conn.begin()
+                try:
+                    engine = await load_draw_engine(mode, cursor)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+        return engine
+    engine = draw_engines[mode]
+    await cursor.execute(f"SELECT draw_number FROM {TABLE_DRAWS} WHERE mode = %s FOR UPDATE", (mode,))
+    round_number = (await cursor.fetchone())[0]
+    await cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE_ENTRIES % mode}")
+    max_id = (await cursor.fetchone())[0]
+    await cursor.execute(f"SELECT id, user_id, wallet_address, combo FROM {TABLE_ENTRIES % mode} WHERE round = %s", (round_number,))
+    rows = await cursor.fetchall()
+    engine.synced_id = 0
+    engine.reset(round_number)
+    for entry_id, user_id, wallet_address, combo in rows:
+        add_stored_entry(engine, round_number, entry_id, user_id, wallet_address, combo)
+    engine.advance_synced(max_id)
+    return engine
+
+async def sync_draw_engine(cursor, mode, round_number):
+    engine = draw_engines[mode]
+    await cursor.execute(f'''
+        SELECT id, user_id, wallet_address, combo FROM {TABLE_ENTRIES % mode}
+        WHERE id > %s AND round = %s
+    ''', (engine.synced_id, round_number))
+    for entry_id, user_id, wallet_address, combo in await cursor.fetchall():
+        add_stored_entry(engine, round_number, entry_id, user_id, wallet_address, combo)
+    await cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE_ENTRIES % mode}")
+    engine.advance_synced((await cursor.fetchone())[0])
+    return engine
+
+async def load_pick_state(user_id):
+    async with db_cursor() as cursor:
+        await cursor.execute(f"SELECT mode, numbers FROM {TABLE_USER_STATE} WHERE user_id = %s", (user_id,))
+        result = await cursor.fetchone()
+    if result is None:
+        return None, []
+    return result[0], parse_combo(result[1]) if result[1] else []
+
+async def save_pick_state(user_id, mode, numbers):
+    async with db_cursor() as cursor:
+        await cursor.execute(f'''
+            INSERT INTO {TABLE_USER_STATE} (user_id, mode, numbers)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE mode = VALUES(mode), numbers = VALUES(numbers)
+        ''', (user_id, mode, ','.join(map(str, numbers))))
+
+async def clear_pick_state(user_id):
+    async with db_cursor() as cursor:
+        await cursor.execute(f"DELETE FROM {TABLE_USER_STATE} WHERE user_id = %s", (user_id,))
+
+async def save_bulk_order(user_id, mode, count):
+    async with db_cursor() as cursor:
+        await cursor.execute(f'''
+            INSERT INTO {TABLE_BULK_ORDERS} (user_id, mode, ticket_count)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE mode = VALUES(mode), ticket_count = VALUES(ticket_count)
+        ''', (user_id, mode, count))
+
+async def claim_bulk_order(user_id, mode, count):
+    async with db_cursor() as cursor:
+        await cursor.execute(
+            f"DELETE FROM {TABLE_BULK_ORDERS} WHERE user_id = %s AND mode = %s AND ticket_count = %s",
+            (user_id, mode, count)
+        )
+        return cursor.rowcount == 1
+
+async def clear_bulk_order(user_id):
+    async with db_cursor() as cursor:
+        await cursor.execute(f"DELETE FROM {TABLE_BULK_ORDERS} WHERE user_id = %s", (user_id,))
+
+async def migrate_json_entries(conn, cursor, mode):
+    await cursor.execute(f"SELECT id, entries FROM {TABLE_LOTTERY % mode} WHERE JSON_LENGTH(entries) > 0")
+    rows = await cursor.fetchall()
+    if not rows:
+        return
+    await cursor.execute(f"SELECT draw_number FROM {TABLE_DRAWS} WHERE mode = %s", (mode,))
+    round_number = (await cursor.fetchone())[0]
+    await conn.begin()
+    try:
+        for row_id, raw_entries in rows:
+            try:
+                entries = json.loads(raw_entries)
+                entries = [json.loads(e) if isinstance(e, str) else e for e in entries]
+            except json.JSONDecodeError:
+                continue
+            await cursor.executemany(f'''
+                INSERT INTO {TABLE_ENTRIES % mode} (round, wallet_address, combo)
+                VALUES (%s, %s, %s)
+            ''', [(round_number, entry["wallet"], combo_key(entry["numbers"])) for entry in entries])
+            await cursor.execute(f"UPDATE {TABLE_LOTTERY % mode} SET entries = '[]' WHERE id = %s", (row_id,))
+        await conn.commit()
+    except Exception:
+        await conn.rollback()
+        raise
+
+def read_legacy_state():
+    draw_info = {}
+    remaining = TOTAL_FREE_ENTRIES
+    if os.path.exists(DRAW_INFO_FILE):
+        with open(DRAW_INFO_FILE, "r") as f:
+            draw_info = json.load(f)
     if os.path.exists(FREE_ENTRIES_FILE):
         with open(FREE_ENTRIES_FILE, "r") as f:
-            data = json.load(f)
-            return data.get("remaining", TOTAL_FREE_ENTRIES)
-    return TOTAL_FREE_ENTRIES
+            remaining = json.load(f).get("remaining", TOTAL_FREE_ENTRIES)
+    return draw_info, remaining
 
-async def save_remaining_free_entries(remaining):
-    with open(FREE_ENTRIES_FILE, "w") as f:
-        json.dump({"remaining": remaining}, f, indent=4)
+async def load_remaining_free_entries():
+    async with db_cursor() as cursor:
+        await cursor.execute(f"SELECT remaining FROM {TABLE_FREE_ENTRIES} WHERE id = 1")
+        result = await cursor.fetchone()
+        return result[0] if result else 0
 
-async def update_user_free_entry(user_id, free_entry_count):
-    pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-    async with pool.acquire() as conn:
+async def claim_free_entry(user_id):
+    async with db_connection() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
-                f"UPDATE {TABLE_USERS} SET free_entry = %s WHERE user_id = %s",
-                (free_entry_count, user_id)
-            )
-    pool.close()
-    await pool.wait_closed()
+            await conn.begin()
+            try:
+                await cursor.execute(f"UPDATE {TABLE_FREE_ENTRIES} SET remaining = remaining - 1 WHERE id = 1 AND remaining > 0")
+                if cursor.rowcount == 0:
+                    await conn.rollback()
+                    free_entries_cache["remaining"] = 0
+                    return False
+                await cursor.execute(f'''
+                    INSERT INTO {TABLE_USERS} (user_id, wallet_address, encrypted_private_key, free_entry)
+                    VALUES (%s, '', '', 1)
+                    ON DUPLICATE KEY UPDATE free_entry = IF(free_entry = 0, 1, free_entry)
+                ''', (user_id,))
+                if cursor.rowcount == 0:
+                    await conn.rollback()
+                    return False
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    if free_entries_cache["remaining"]:
+        free_entries_cache["remaining"] -= 1
+    update_cached_profile(user_id, free_entry=1)
+    return True
 
-async def get_user_free_entry(user_id):
-    pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-    async with pool.acquire() as conn:
+async def get_remaining_free_entries():
+    if free_entries_cache["remaining"] is None or time.monotonic() - free_entries_cache["loaded_at"] > ROUND_CACHE_TTL:
+        free_entries_cache["remaining"] = await load_remaining_free_entries()
+        free_entries_cache["loaded_at"] = time.monotonic()
+    return free_entries_cache["remaining"]
+
+async def load_round_state(mode):
+    draw_info = await load_draw_info(mode)
+    async with db_cursor() as cursor:
+        await cursor.execute(f"SELECT COUNT(*) FROM {TABLE_ENTRIES % mode} WHERE round = %s", (draw_info["draw_number"],))
+        entry_count = (await cursor.fetchone())[0]
+        await cursor.execute(f"SELECT prize_pool FROM {TABLE_PRIZES} WHERE mode = %s", (mode,))
+        prize_pool = (await cursor.fetchone() or [0])[0]
+    state = {
+        "round": draw_info["draw_number"],
+        "next_draw_time": draw_info["next_draw_time"],
+        "entry_count": entry_count,
+        "prize_pool": prize_pool,
+        "loaded_at": time.monotonic()
+    }
+    round_state_cache[mode] = state
+    return state
+
+async def get_round_state(mode):
+    state = round_state_cache.get(mode)
+    if state is None or time.monotonic() - state["loaded_at"] > ROUND_CACHE_TTL:
+        state = await load_round_state(mode)
+    return state
+
+def update_round_state(mode, round_number, entries=0, prize_pool=0):
+    state = round_state_cache.get(mode)
+    if state is None:
+        return
+    if state["round"] != round_number:
+        invalidate_round_state(mode)
+        return
+    state["entry_count"] += entries
+    state["prize_pool"] += prize_pool
+
+def invalidate_round_state(mode):
+    round_state_cache.pop(mode, None)
+
+async def load_user_profile(user_id):
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        profile_cache.move_to_end(user_id)
+        return profile
+    async with db_cursor() as cursor:
+        await cursor.execute(f'''
+            INSERT INTO {TABLE_USERS} (user_id, wallet_address, encrypted_private_key)
+            VALUES (%s, '', '')
+            ON DUPLICATE KEY UPDATE user_id = user_id
+        ''', (user_id,))
+        await cursor.execute(f"SELECT wallet_address, earned, free_entry FROM {TABLE_USERS} WHERE user_id = %s", (user_id,))
+        wallet_address, earned, free_entry = await cursor.fetchone()
+    profile = {"wallet_address": wallet_address or None, "earned": earned, "free_entry": free_entry}
+    profile_cache[user_id] = profile
+    if len(profile_cache) > PROFILE_CACHE_SIZE:
+        profile_cache.popitem(last=False)
+    return profile
+
+def update_cached_profile(user_id, **fields):
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        profile.update(fields)
+
+async def reserve_data_key(uses):
+    async with data_key_lock:
+        if (data_key_cache["plaintext"] is None
+                or time.monotonic() - data_key_cache["created"] > DATA_KEY_MAX_AGE
+                or data_key_cache["uses"] + uses > DATA_KEY_MAX_USES):
+            response = await asyncio.to_thread(kms_client.generate_data_key, KeyId=KMS_KEY_ID, KeySpec='AES_256')
+            data_key_cache.update(plaintext=response['Plaintext'], encrypted=response['CiphertextBlob'], created=time.monotonic(), uses=0)
+        data_key_cache["uses"] += uses
+        return data_key_cache["plaintext"], data_key_cache["encrypted"]
+
+def generate_wallets(count, data_key, encrypted_data_key):
+    aesgcm = AESGCM(data_key)
+    encoded_data_key = base64.b64encode(encrypted_data_key).decode()
+    wallets = []
+    for _ in range(count):
+        keypair = Keypair()
+        nonce = os.urandom(12)
+        ciphertext = aesgcm.encrypt(nonce, bytes(keypair), None)
+        wallets.append((
+            str(keypair.pubkey()),
+            f"v1:{encoded_data_key}:{base64.b64encode(nonce).decode()}:{base64.b64encode(ciphertext).decode()}"
+        ))
+    return wallets
+
+async def create_wallets(count):
+    data_key, encrypted_data_key = await reserve_data_key(count)
+    return await asyncio.to_thread(generate_wallets, count, data_key, encrypted_data_key)
+
+async def refill_wallet_pool():
+    async with db_cursor() as cursor:
+        await cursor.execute("SELECT GET_LOCK(%s, 0)", (WALLET_POOL_LOCK_NAME,))
+        if (await cursor.fetchone())[0] != 1:
+            return 0
+        try:
+            await cursor.execute(f"SELECT COUNT(*) FROM {TABLE_WALLET_POOL}")
+            available = (await cursor.fetchone())[0]
+            if available >= WALLET_POOL_LOW:
+                return 0
+            missing = WALLET_POOL_TARGET - available
+            while missing > 0:
+                wallets = await create_wallets(min(missing, WALLET_POOL_BATCH))
+                await cursor.executemany(f'''
+                    INSERT INTO {TABLE_WALLET_POOL} (wallet_address, encrypted_private_key)
+                    VALUES (%s, %s)
+                ''', wallets)
+                missing -= len(wallets)
+            return WALLET_POOL_TARGET - available
+        finally:
+            await cursor.execute("SELECT RELEASE_LOCK(%s)", (WALLET_POOL_LOCK_NAME,))
+
+async def run_wallet_pool():
+    while True:
+        try:
+            await refill_wallet_pool()
+        except Exception:
+            logging.exception("Wallet pool refill failed")
+        try:
+            await asyncio.wait_for(wallet_pool_refill.wait(), timeout=WALLET_POOL_CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        wallet_pool_refill.clear()
+
+async def claim_wallet(user_id, fallback=None):
+    async with db_connection() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(
-                f"SELECT free_entry FROM {TABLE_USERS} WHERE user_id = %s",
-                (user_id,)
-            )
-            result = await cursor.fetchone()
-            return result[0] if result else 0
-    pool.close()
-    await pool.wait_closed()
+            await conn.begin()
+            try:
+                await cursor.execute(f"SELECT wallet_address FROM {TABLE_USERS} WHERE user_id = %s FOR UPDATE", (user_id,))
+                result = await cursor.fetchone()
+                if result and result[0]:
+                    await conn.commit()
+                    return result[0]
+                await cursor.execute(f'''
+                    SELECT id, wallet_address, encrypted_private_key FROM {TABLE_WALLET_POOL}
+                    ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+                ''')
+                pooled = await cursor.fetchone()
+                if pooled:
+                    await cursor.execute(f"DELETE FROM {TABLE_WALLET_POOL} WHERE id = %s", (pooled[0],))
+                    wallet_address, encrypted_private_key = pooled[1], pooled[2]
+                elif fallback:
+                    wallet_address, encrypted_private_key = fallback
+                else:
+                    await conn.rollback()
+                    return None
+                await cursor.execute(f'''
+                    INSERT INTO {TABLE_USERS} (user_id, wallet_address, encrypted_private_key)
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE wallet_address = VALUES(wallet_address), encrypted_private_key = VALUES(encrypted_private_key)
+                ''', (user_id, wallet_address, encrypted_private_key))
+                await conn.commit()
+                return wallet_address
+            except Exception:
+                await conn.rollback()
+                raise
+
+async def assign_wallet(user_id):
+    wallet_address = await claim_wallet(user_id)
+    if wallet_address is None:
+        wallet_address = await claim_wallet(user_id, (await create_wallets(1))[0])
+    wallet_pool_refill.set()
+    update_cached_profile(user_id, wallet_address=wallet_address)
+    return wallet_address
 
 async def private_chat_only(update: Update, context: CallbackContext):
     return update.effective_chat.type == 'private'
@@ -148,28 +1101,130 @@ async def create_start_task(update: Update, context: CallbackContext):
     if not await private_chat_only(update, context):
         return
     user_id = update.effective_user.id
-    current_time = time.time()
-    if user_id in user_last_start_time and (current_time - user_last_start_time[user_id]) < START_COMMAND_COOLDOWN:
-        user_spam_count[user_id] = user_spam_count.get(user_id, 0) + 1
-        cooldown_time = min(START_COMMAND_COOLDOWN + (user_spam_count[user_id] * 3), MAX_START_COMMAND_COOLDOWN)
-        if user_id not in user_notified:
-            user_notified[user_id] = True
-            await update.message.reply_text(f"Please wait {cooldown_time} seconds before trying again.")
+    retry_after, notify = start_limiter.hit(user_id)
+    if retry_after:
+        if notify:
+            await update.message.reply_text(f"Please wait {math.ceil(retry_after)} seconds before trying again.")
         return
-    else:
-        user_spam_count[user_id] = 0
-        user_notified[user_id] = False
-    user_last_start_time[user_id] = current_time
-    asyncio.create_task(start(update, context, user_id))
+    async def handle_start():
+        with metrics.span("start", update):
+            await start(update, context, user_id)
+    dispatcher.submit(user_id, handle_start)
+
+@functools.lru_cache(maxsize=None)
+def welcome_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎲 Lottery (Match 3/20)", callback_data='medium_mode')],
+        [InlineKeyboardButton("How to Play?", callback_data='info'), InlineKeyboardButton("Wallet", callback_data='wallet')],
+    ])
+
+@functools.lru_cache(maxsize=None)
+def mode_keyboard(mode):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Pick Numbers", callback_data=f'pick_{mode}')],
+        [InlineKeyboardButton("Random Numbers", callback_data=f'random_{mode}')],
+        *([[InlineKeyboardButton("Bulk Quick Pick", callback_data=f'bulk_{mode}')]] if PAYMENTS_ENABLED else []),
+        [InlineKeyboardButton("Cancel", callback_data='cancel')]
+    ])
+
+@functools.lru_cache(maxsize=None)
+def number_picker_keyboard(mode):
+    buttons = []
+    for i in range(1, GAME_MODES[mode]['range'] + 1):
+        if i % 5 == 1:
+            buttons.append([])
+        buttons[-1].append(InlineKeyboardButton(str(i), callback_data=f'number_{i}'))
+    return InlineKeyboardMarkup(buttons)
+
+def parse_bulk_data(data):
+    parts = data.split('_')
+    if not PAYMENTS_ENABLED or len(parts) != 3 or parts[1] not in GAME_MODES or not parts[2].isdigit():
+        return None, None
+    count = int(parts[2])
+    return (parts[1], count) if count in BULK_TICKET_OPTIONS else (None, None)
+
+@functools.lru_cache(maxsize=None)
+def bulk_keyboard(mode):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(str(count), callback_data=f'bulkbuy_{mode}_{count}') for count in BULK_TICKET_OPTIONS],
+        [InlineKeyboardButton("Cancel", callback_data='cancel')]
+    ])
+
+@functools.lru_cache(maxsize=None)
+def confirm_keyboard(callback_data):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Confirm", callback_data=callback_data)],
+        [InlineKeyboardButton("Cancel", callback_data='cancel')]
+    ])
+
+@functools.lru_cache(maxsize=None)
+def wallet_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Secret Key", callback_data='secret_key')],
+        [InlineKeyboardButton("Cancel", callback_data='cancel')]
+    ])
+
+@functools.lru_cache(maxsize=None)
+def back_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data='cancel')]])
+
+@functools.lru_cache(maxsize=None)
+def info_text():
+    return (
+        f"*🎰 Solttery Lottery - How to Play*\n\n"
+        f"1. Pick 3 numbers between 1 and 20.\n"
+        f"2. Pay the entry fee.\n"
+        f"3. Wait for the draw.\n"
+        f"4. Match all three numbers to win!"
+    )
+
+def remember_view(chat_id, message_id, text, reply_markup):
+    if not RENDER_CACHE_SIZE:
+        return
+    rendered_views[(chat_id, message_id)] = (text, reply_markup)
+    rendered_views.move_to_end((chat_id, message_id))
+    if len(rendered_views) > RENDER_CACHE_SIZE:
+        rendered_views.popitem(last=False)
+
+async def edit_view(query, text, reply_markup=None, **kwargs):
+    key = (query.message.chat_id, query.message.message_id) if query.message else None
+    if key is not None and rendered_views.get(key) == (text, reply_markup):
+        return False
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    if key is not None:
+        remember_view(*key, text, reply_markup)
+    return True
+
+async def send_view(bot, chat_id, text, reply_markup=None, **kwargs):
+    message = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, **kwargs)
+    remember_view(chat_id, message.message_id, text, reply_markup)
+    return message
+
+async def stats(update: Update, context: CallbackContext):
+    if not await private_chat_only(update, context):
+        return
+    user_id = update.effective_user.id
+    retry_after, _ = callback_limiter.hit(user_id)
+    if retry_after:
+        return
+    async def send_stats():
+        with metrics.span("stats", update):
+            texts = [await get_stats_text(mode) for mode in GAME_MODES]
+            await update.message.reply_text("\n\n".join(texts), parse_mode="markdown")
+    dispatcher.submit(user_id, send_stats)
 
-async def start(update: Update, context: Application, user_id: int = None):
+async def start(update: Update, context: Application, user_id: int = None, edit: bool = False):
     if not await private_chat_only(update, context):
         return
     user_id = user_id or update.effective_user.id
-    await asyncio.sleep(2.5)
-    remaining_free_entries = await load_remaining_free_entries()
-    wallet_address = None
-    free_entry_count = await get_user_free_entry(user_id)
+    remaining_free_entries = await get_remaining_free_entries()
+    profile = await load_user_profile(user_id)
+    wallet_address = profile["wallet_address"]
+    free_entry_count = profile["free_entry"]
     balance_formatted = "0.000"
     spl_balance_formatted = "0"
     if wallet_address:
@@ -178,37 +1233,17 @@ async def start(update: Update, context: Application, user_id: int = None):
         spl_balance = 0
         spl_balance_formatted = round(spl_balance)
     else:
-        private_key = Keypair()
-        wallet_address = str(private_key.pubkey())
-        await asyncio.sleep(1)
-        if remaining_free_entries > 0 and free_entry_count == 0:
+        wallet_address = await assign_wallet(user_id)
+        if remaining_free_entries > 0 and free_entry_count == 0 and await claim_free_entry(user_id):
             free_entry_count = 1
-            remaining_free_entries -= 1
-            await asyncio.gather(
-                update_user_free_entry(user_id, free_entry_count),
-                save_remaining_free_entries(remaining_free_entries)
-            )
-    pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(f"SELECT entries FROM {TABLE_LOTTERY % 'medium'} WHERE id = 1")
-            result = await cursor.fetchone()
-            total_entries = 0
-            if result and result[0]:
-                try:
-                    entries = json.loads(result[0])
-                    total_entries = len(entries)
-                except json.JSONDecodeError:
-                    total_entries = 0
-            await cursor.execute(f"SELECT mode, prize_pool FROM {TABLE_PRIZES}")
-            prize_pools = {row[0]: row[1] for row in await cursor.fetchall()}
-    pool.close()
-    await pool.wait_closed()
-    draw_info = await load_draw_info("medium")
-    next_draw_time = draw_info["next_draw_time"]
+            remaining_free_entries = await get_remaining_free_entries()
+    round_state = await get_round_state("medium")
+    total_entries = round_state["entry_count"]
+    next_draw_time = round_state["next_draw_time"]
     if next_draw_time is None:
-        next_draw_time = time.time() + 3600
-        await save_draw_info("medium", draw_info["draw_number"], next_draw_time)
+        next_draw_time = next_draw_boundary(time.time())
+        await save_draw_info("medium", round_state["round"], next_draw_time)
+        round_state["next_draw_time"] = next_draw_time
     utc_draw_time = datetime.datetime.fromtimestamp(next_draw_time, tz=datetime.timezone.utc)
     next_draw_str = utc_draw_time.strftime("%H:%M %d/%m/%Y")
     welcome_message = (
@@ -218,7 +1253,7 @@ async def start(update: Update, context: Application, user_id: int = None):
         f"• Pick 3 numbers from 1 to 20\n"
         f"• Every entry increases the prize pool\n"
         f"• Match all three numbers, in any order, then you win!\n"
-        f"• Prize Pool: {round(prize_pools.get('medium', 0) * 0.66)} SOLTTERY\n"
+        f"• Prize Pool: {round(round_state['prize_pool'] * 0.66)} SOLTTERY\n"
         f"• *Next Draw at:* {next_draw_str} UTC\n\n"
         f"💰 *Your Info:*\n"
         f"• *Sol Balance:* {balance_formatted} Sol\n"
@@ -229,255 +1264,596 @@ async def start(update: Update, context: Application, user_id: int = None):
         f"• *Free Entries Remaining:* {remaining_free_entries}/{TOTAL_FREE_ENTRIES}\n\n"
         f"✨ *Choose your numbers and go for the win!*"
     )
-    keyboard = [
-        [InlineKeyboardButton("🎲 Lottery (Match 3/20)", callback_data='medium_mode')],
-        [InlineKeyboardButton("How to Play?", callback_data='info'), InlineKeyboardButton("Wallet", callback_data='wallet')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    if update.message:
-        await update.message.reply_text(welcome_message, reply_markup=reply_markup, parse_mode="markdown")
-    elif update.callback_query:
-        await context.bot.send_message(chat_id=user_id, text=welcome_message, reply_markup=reply_markup, parse_mode="markdown")
+    reply_markup = welcome_keyboard()
+    if edit and update.callback_query:
+        await edit_view(update.callback_query, welcome_message, reply_markup, parse_mode="markdown")
+    elif update.message:
+        message = await update.message.reply_text(welcome_message, reply_markup=reply_markup, parse_mode="markdown")
+        remember_view(message.chat_id, message.message_id, welcome_message, reply_markup)
     else:
-        await context.bot.send_message(chat_id=user_id, text=welcome_message, reply_markup=reply_markup, parse_mode="markdown")
+        await send_view(context.bot, user_id, welcome_message, reply_markup, parse_mode="markdown")
 
 async def button(update: Update, context: Application):
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
+    retry_after, notify = callback_limiter.hit(user_id)
+    if retry_after:
+        await query.answer(f"Slow down! Try again in {math.ceil(retry_after)}s." if notify else None)
+        return
     async def handle_query():
         if query.data == 'info':
-            await query.edit_message_text(
-                f"*🎰 Solttery Lottery - How to Play*\n\n"
-                f"1. Pick 3 numbers between 1 and 20.\n"
-                f"2. Pay the entry fee.\n"
-                f"3. Wait for the draw.\n"
-                f"4. Match all three numbers to win!",
-                parse_mode='Markdown'
-            )
-            await start(update, context, user_id=user_id)
+            await edit_view(query, info_text(), back_keyboard(), parse_mode='Markdown')
         elif query.data == 'medium_mode':
             mode = "medium"
             config = GAME_MODES[mode]
-            pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-            async with pool.acquire() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute(f"SELECT prize_pool FROM {TABLE_PRIZES} WHERE mode = %s", (mode,))
-                    prize_pool = (await cursor.fetchone() or [0])[0]
-            pool.close()
-            await pool.wait_closed()
+            prize_pool = (await get_round_state(mode))["prize_pool"]
             winnable_prize = prize_pool * 0.7
-            await query.edit_message_text(
+            await edit_view(
+                query,
                 f"*{mode.capitalize()} Mode*\n\n"
                 f"Pick {config['numbers_to_pick']} numbers from 1-{config['range']}\n"
                 f"Entry Fee: {config['entry_fee']} SOLTTERY\n"
                 f"Prize: {winnable_prize:.3f} SOLTTERY\n\n"
                 "Would you like to pick numbers or get random ones?",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Pick Numbers", callback_data=f'pick_{mode}')],
-                    [InlineKeyboardButton("Random Numbers", callback_data=f'random_{mode}')],
-                    [InlineKeyboardButton("Cancel", callback_data='cancel')]
-                ]),
+                mode_keyboard(mode),
                 parse_mode='Markdown'
             )
-        elif query.data.startswith('pick_'):
+        elif query.data.startswith('bulk_'):
             mode = query.data.split('_')[1]
+            if not PAYMENTS_ENABLED or mode not in GAME_MODES:
+                return
+            await edit_view(query, "How many random tickets would you like?", bulk_keyboard(mode))
+        elif query.data.startswith('bulkbuy_'):
+            mode, count = parse_bulk_data(query.data)
+            if mode is None:
+                await edit_view(query, "Invalid entry.")
+                await start(update, context, user_id=user_id)
+                return
+            config = GAME_MODES[mode]
+            await save_bulk_order(user_id, mode, count)
+            await edit_view(
+                query,
+                f"Buy {count} random {mode.capitalize()} tickets?\n"
+                f"Entry Fee: {count * config['entry_fee']} SOLTTERY ({count} x {config['entry_fee']})",
+                confirm_keyboard(f'bulkconfirm_{mode}_{count}')
+            )
+        elif query.data.startswith('bulkconfirm_'):
+            mode, count = parse_bulk_data(query.data)
+            if mode is None or not await claim_bulk_order(user_id, mode, count):
+                await edit_view(query, "Invalid entry.")
+                await start(update, context, user_id=user_id)
+                return
+            await edit_view(query, "Processing...")
             config = GAME_MODES[mode]
-            context.user_data['mode'] = mode
-            context.user_data['numbers'] = []
-            await show_number_picker(query, context, config, 1)
+            wallet_address = (await load_user_profile(user_id))["wallet_address"] or "placeholder_wallet"
+            if await process_payment(user_id, wallet_address, count * config['entry_fee']):
+                tickets = draw_engines[mode].random_tickets(count)
+                await save_entries(mode, user_id, wallet_address, tickets)
+                await edit_view(
+                    query,
+                    f"{count} entries confirmed!\n"
+                    + "\n".join(', '.join(map(str, numbers)) for numbers in tickets)
+                    + "\nWaiting for the draw..."
+                )
+                await start(update, context, user_id=user_id)
+            else:
+                await edit_view(query, "Payment processing not implemented in public version.")
+                await start(update, context, user_id=user_id)
+        elif query.data.startswith('pick_'):
+            mode = query.data.split('_')[1]
+            if mode not in GAME_MODES:
+                return
+            await save_pick_state(user_id, mode, [])
+            await show_number_picker(query, context, mode, 1)
         elif query.data.startswith('random_'):
             mode = query.data.split('_')[1]
+            if mode not in GAME_MODES:
+                return
             config = GAME_MODES[mode]
-            context.user_data['mode'] = mode
             numbers = sorted(random.sample(range(1, config['range'] + 1), config['numbers_to_pick']))
-            context.user_data['numbers'] = numbers
+            await save_pick_state(user_id, mode, numbers)
             await confirm_entry(query, context, mode, numbers)
         elif query.data.startswith('number_'):
-            mode = context.user_data.get('mode')
+            mode, numbers = await load_pick_state(user_id)
             if not mode:
-                await query.edit_message_text("Please select a game mode first.")
+                await edit_view(query, "Please select a game mode first.")
                 await start(update, context, user_id=user_id)
                 return
             config = GAME_MODES[mode]
-            number = int(query.data.split('_')[1])
-            numbers = context.user_data.get('numbers', [])
-            if number not in numbers:
+            number = query.data.split('_')[1]
+            if not number.isdigit() or not 1 <= int(number) <= config['range']:
+                return
+            number = int(number)
+            if number not in numbers and len(numbers) < config['numbers_to_pick']:
                 numbers.append(number)
-                context.user_data['numbers'] = numbers
+                await save_pick_state(user_id, mode, numbers)
             if len(numbers) < config['numbers_to_pick']:
-                await show_number_picker(query, context, config, len(numbers) + 1)
+                await show_number_picker(query, context, mode, len(numbers) + 1)
             else:
                 await confirm_entry(query, context, mode, sorted(numbers))
         elif query.data.startswith('confirm_'):
-            await query.edit_message_text("Processing...")
+            await edit_view(query, "Processing...")
             mode = query.data.split('_')[1]
-            config = GAME_MODES[mode]
-            numbers = context.user_data.get('numbers', [])
-            if not numbers or len(numbers) != config['numbers_to_pick']:
-                await query.edit_message_text("Invalid entry.")
+            state_mode, numbers = await load_pick_state(user_id)
+            if state_mode != mode or not is_valid_ticket(mode, numbers):
+                await edit_view(query, "Invalid entry.")
                 await start(update, context, user_id=user_id)
                 return
-            free_entry = await get_user_free_entry(user_id)
-            if free_entry > 0:
-                await query.edit_message_text(
+            config = GAME_MODES[mode]
+            wallet_address = (await load_user_profile(user_id))["wallet_address"] or "placeholder_wallet"
+            if await save_entry_free(mode, user_id, wallet_address, numbers):
+                await edit_view(
+                    query,
                     f"Entry confirmed!\nNumbers: {', '.join(map(str, numbers))}\n"
                     f"TX - Free entry\nWaiting for the draw...",
                     parse_mode='Markdown', disable_web_page_preview=True
                 )
-                await save_entry_free(mode, "placeholder_wallet", numbers)
-                context.user_data.pop('mode', None)
-                context.user_data.pop('numbers', None)
-                await update_user_free_entry(user_id, 0)
+                await clear_pick_state(user_id)
+                await start(update, context, user_id=user_id)
+            elif await process_payment(user_id, wallet_address, config['entry_fee']):
+                await save_entry(mode, user_id, wallet_address, numbers)
+                await edit_view(
+                    query,
+                    f"Entry confirmed!\nNumbers: {', '.join(map(str, numbers))}\n"
+                    f"Waiting for the draw...",
+                    parse_mode='Markdown', disable_web_page_preview=True
+                )
+                await clear_pick_state(user_id)
                 await start(update, context, user_id=user_id)
             else:
-                await query.edit_message_text("Payment processing not implemented in public version.")
+                await edit_view(query, "Payment processing not implemented in public version.")
                 await start(update, context, user_id=user_id)
         elif query.data == 'cancel':
-            context.user_data.pop('mode', None)
-            context.user_data.pop('numbers', None)
-            await query.message.delete()
-            await start(update, context, user_id=user_id)
+            await clear_pick_state(user_id)
+            if PAYMENTS_ENABLED:
+                await clear_bulk_order(user_id)
+            await start(update, context, user_id=user_id, edit=True)
         elif query.data == 'wallet':
-            keyboard = [
-                [InlineKeyboardButton("Secret Key", callback_data='secret_key')],
-                [InlineKeyboardButton("Cancel", callback_data='cancel')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Wallet options:", reply_markup=reply_markup)
+            await edit_view(query, "Wallet options:", wallet_keyboard())
         elif query.data == 'secret_key':
-            await query.edit_message_text("Secret key retrieval not implemented in public version.")
+            await edit_view(query, "Secret key retrieval not implemented in public version.")
             await start(update, context, user_id=user_id)
-    asyncio.create_task(handle_query())
+    async def handle_button():
+        action = (query.data or "").split('_')[0]
+        with metrics.span("button", update, action=action if action in METRICS_BUTTON_ACTIONS else "other"):
+            await handle_query()
+    dispatcher.submit(user_id, handle_button)
+    await query.answer()
 
-async def show_number_picker(query, context, config, pick_number):
-    buttons = []
-    for i in range(1, config['range'] + 1):
-        if i % 5 == 1:
-            buttons.append([])
-        buttons[-1].append(InlineKeyboardButton(str(i), callback_data=f'number_{i}'))
-    await query.edit_message_text(
+async def show_number_picker(query, context, mode, pick_number):
+    config = GAME_MODES[mode]
+    await edit_view(
+        query,
         f"Pick number {pick_number}/{config['numbers_to_pick']} (1-{config['range']})",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        number_picker_keyboard(mode)
     )
 
 async def confirm_entry(query, context, mode, numbers):
     config = GAME_MODES[mode]
-    pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(f"SELECT prize_pool FROM {TABLE_PRIZES} WHERE mode = %s", (mode,))
-            prize_pool = (await cursor.fetchone() or [0])[0]
-    pool.close()
-    await pool.wait_closed()
+    prize_pool = (await get_round_state(mode))["prize_pool"]
     winnable_prize = prize_pool * 0.7
-    await query.edit_message_text(
+    await edit_view(
+        query,
         f"Confirm your {mode.capitalize()} entry?\n"
         f"Numbers: {', '.join(map(str, numbers))}\n"
         f"Entry Fee: {config['entry_fee']} SOLTTERY\n"
         f"Prize: {winnable_prize:.3f} SOLTTERY",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Confirm", callback_data=f'confirm_{mode}')],
-            [InlineKeyboardButton("Cancel", callback_data='cancel')]
-        ]),
+        confirm_keyboard(f'confirm_{mode}'),
         parse_mode='Markdown'
     )
 
-async def save_entry(mode, wallet_address, numbers):
-    pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-    async with pool.acquire() as conn:
+async def lock_current_round(cursor, mode):
+    await cursor.execute(f"SELECT draw_number FROM {TABLE_DRAWS} WHERE mode = %s LOCK IN SHARE MODE", (mode,))
+    return (await cursor.fetchone())[0]
+
+async def save_entry(mode, user_id, wallet_address, numbers):
+    entry_fee = GAME_MODES[mode]["entry_fee"]
+    async with db_connection() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(f'''
-                UPDATE {TABLE_LOTTERY % mode}
-                SET entries = JSON_ARRAY_APPEND(entries, '$', %s)
-                WHERE id = 1
-            ''', (json.dumps({"wallet": wallet_address, "numbers": numbers}),))
-            entry_fee = GAME_MODES[mode]["entry_fee"]
-            await cursor.execute(f'''
-                UPDATE {TABLE_PRIZES}
-                SET prize_pool = prize_pool + %s
-                WHERE mode = %s
-            ''', (entry_fee, mode))
-    pool.close()
-    await pool.wait_closed()
+            await conn.begin()
+            try:
+                round_number = await lock_current_round(cursor, mode)
+                await cursor.execute(f'''
+                    INSERT INTO {TABLE_ENTRIES % mode} (round, user_id, wallet_address, combo)
+                    VALUES (%s, %s, %s, %s)
+                ''', (round_number, user_id, wallet_address, combo_key(numbers)))
+                entry_id = cursor.lastrowid
+                await cursor.execute(f'''
+                    UPDATE {TABLE_PRIZES}
+                    SET prize_pool = prize_pool + %s
+                    WHERE mode = %s
+                ''', (entry_fee, mode))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    if is_draw_leader:
+        draw_engines[mode].add(round_number, numbers, (user_id, wallet_address), entry_id)
+    update_round_state(mode, round_number, entries=1, prize_pool=entry_fee)
+    metrics.inc("solttery_entries_total", mode=mode, kind="paid")
 
-async def save_entry_free(mode, wallet_address, numbers):
-    pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-    async with pool.acquire() as conn:
+async def save_entry_free(mode, user_id, wallet_address, numbers):
+    async with db_connection() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(f'''
-                UPDATE {TABLE_LOTTERY % mode}
-                SET entries = JSON_ARRAY_APPEND(entries, '$', %s)
-                WHERE id = 1
-            ''', (json.dumps({"wallet": wallet_address, "numbers": numbers}),))
-    pool.close()
-    await pool.wait_closed()
+            await conn.begin()
+            try:
+                await cursor.execute(f'''
+                    UPDATE {TABLE_USERS} SET free_entry = free_entry - 1
+                    WHERE user_id = %s AND free_entry > 0
+                ''', (user_id,))
+                if cursor.rowcount == 0:
+                    await conn.rollback()
+                    update_cached_profile(user_id, free_entry=0)
+                    return False
+                round_number = await lock_current_round(cursor, mode)
+                await cursor.execute(f'''
+                    INSERT INTO {TABLE_ENTRIES % mode} (round, user_id, wallet_address, combo, free_entry)
+                    VALUES (%s, %s, %s, %s, 1)
+                ''', (round_number, user_id, wallet_address, combo_key(numbers)))
+                entry_id = cursor.lastrowid
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    if is_draw_leader:
+        draw_engines[mode].add(round_number, numbers, (user_id, wallet_address), entry_id)
+    update_round_state(mode, round_number, entries=1)
+    metrics.inc("solttery_entries_total", mode=mode, kind="free")
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        profile["free_entry"] = max(0, profile["free_entry"] - 1)
+    return True
+
+async def save_entries(mode, user_id, wallet_address, tickets):
+    entry_fee = GAME_MODES[mode]["entry_fee"]
+    async with db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            try:
+                round_number = await lock_current_round(cursor, mode)
+                await cursor.executemany(f'''
+                    INSERT INTO {TABLE_ENTRIES % mode} (round, user_id, wallet_address, combo)
+                    VALUES (%s, %s, %s, %s)
+                ''', [(round_number, user_id, wallet_address, combo_key(numbers)) for numbers in tickets])
+                first_id = cursor.lastrowid
+                await cursor.execute(f'''
+                    UPDATE {TABLE_PRIZES}
+                    SET prize_pool = prize_pool + %s
+                    WHERE mode = %s
+                ''', (entry_fee * len(tickets), mode))
+                await cursor.execute(f'''
+                    SELECT id, combo FROM {TABLE_ENTRIES % mode}
+                    WHERE round = %s AND user_id = %s AND id >= %s
+                ''', (round_number, user_id, first_id))
+                inserted = await cursor.fetchall()
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    if is_draw_leader:
+        engine = draw_engines[mode]
+        for entry_id, combo in inserted:
+            engine.add(round_number, parse_combo(combo), (user_id, wallet_address), entry_id)
+    update_round_state(mode, round_number, entries=len(tickets), prize_pool=entry_fee * len(tickets))
+    metrics.inc("solttery_entries_total", len(tickets), mode=mode, kind="bulk")
+
+async def process_payment(user_id, wallet_address, amount):
+    if PAYMENTS_ENABLED:
+        raise NotImplementedError("PAYMENTS_ENABLED is set but no payment backend is configured")
+    return False
 
 async def load_draw_info(mode):
-    if os.path.exists(DRAW_INFO_FILE):
-        with open(DRAW_INFO_FILE, "r") as f:
-            data = json.load(f)
-            return data.get(mode, {"draw_number": 1, "next_draw_time": None})
-    return {"draw_number": 1, "next_draw_time": None}
+    async with db_cursor() as cursor:
+        await cursor.execute(f"SELECT draw_number, next_draw_time FROM {TABLE_DRAWS} WHERE mode = %s", (mode,))
+        result = await cursor.fetchone()
+    if result is None:
+        return {"draw_number": 1, "next_draw_time": None}
+    return {"draw_number": result[0], "next_draw_time": result[1]}
 
 async def save_draw_info(mode, draw_number, next_draw_time):
-    data = {}
-    if os.path.exists(DRAW_INFO_FILE):
-        with open(DRAW_INFO_FILE, "r") as f:
-            data = json.load(f)
-    data[mode] = {"draw_number": draw_number, "next_draw_time": next_draw_time}
-    with open(DRAW_INFO_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+    async with db_cursor() as cursor:
+        await cursor.execute(f'''
+            INSERT INTO {TABLE_DRAWS} (mode, draw_number, next_draw_time)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE draw_number = VALUES(draw_number), next_draw_time = VALUES(next_draw_time)
+        ''', (mode, draw_number, next_draw_time))
+
+def next_draw_boundary(after):
+    return (math.floor(after / DRAW_INTERVAL) + 1) * DRAW_INTERVAL
 
-async def monitor_lottery(mode):
+async def draw_lottery(mode):
     config = GAME_MODES[mode]
-    pool = await aiomysql.create_pool(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
-    draw_info = await load_draw_info(mode)
-    round_number = draw_info["draw_number"]
-    next_draw_time = draw_info["next_draw_time"]
-    if next_draw_time is None:
-        next_draw_time = time.time() + 3600
-        await save_draw_info(mode, round_number, next_draw_time)
-    while True:
-        current_time = time.time()
-        if current_time >= next_draw_time:
-            async with pool.acquire() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute(f"SELECT entries FROM {TABLE_LOTTERY % mode} WHERE id = 1")
-                    result = await cursor.fetchone()
-                    entries = []
-                    if result and result[0]:
-                        try:
-                            entries = json.loads(result[0])
-                            entries = [json.loads(e) if isinstance(e, str) else e for e in entries]
-                        except json.JSONDecodeError:
-                            entries = []
-                    winning_numbers = sorted(random.sample(range(1, config['range'] + 1), config['numbers_to_pick']))
-                    winners = [entry for entry in entries if sorted(entry["numbers"]) == winning_numbers]
-                    await cursor.execute(f"SELECT prize_pool FROM {TABLE_PRIZES} WHERE mode = %s", (mode,))
-                    prize_pool = (await cursor.fetchone() or [0])[0]
-                    winnable_amount = prize_pool * 0.66
-                    remaining_pool = prize_pool * 0.34
-                    if winners:
-                        await cursor.execute(f"UPDATE {TABLE_PRIZES} SET prize_pool = %s WHERE mode = %s", (remaining_pool, mode))
-                    await cursor.execute(f"UPDATE {TABLE_LOTTERY % mode} SET entries = '[]' WHERE id = 1")
-                    round_number += 1
-                    next_draw_time = time.time() + 3600
-                    await save_draw_info(mode, round_number, next_draw_time)
-        time_to_next_draw = next_draw_time - time.time()
-        await asyncio.sleep(min(10, max(1, time_to_next_draw)))
-    pool.close()
-    await pool.wait_closed()
+    engine = draw_engines[mode]
+    winning_numbers = sorted(random.sample(range(1, config['range'] + 1), config['numbers_to_pick']))
+    next_draw_time = next_draw_boundary(time.time())
+    async with db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await conn.begin()
+            try:
+                await cursor.execute(f"SELECT draw_number, next_draw_time FROM {TABLE_DRAWS} WHERE mode = %s FOR UPDATE", (mode,))
+                round_number, stored_draw_time = await cursor.fetchone()
+                if stored_draw_time is not None and stored_draw_time > time.time():
+                    await conn.rollback()
+                    return stored_draw_time
+                if engine.round != round_number:
+                    await load_draw_engine(mode, cursor)
+                else:
+                    await sync_draw_engine(cursor, mode, round_number)
+                winners = engine.winners(winning_numbers)
+                await cursor.execute(f"SELECT prize_pool FROM {TABLE_PRIZES} WHERE mode = %s", (mode,))
+                prize_pool = (await cursor.fetchone() or [0])[0]
+                winnable_amount = prize_pool * 0.66
+                remaining_pool = prize_pool * 0.34
+                payout = engine.payout_per_winner(winning_numbers, winnable_amount)
+                if winners:
+                    await cursor.execute(f"UPDATE {TABLE_PRIZES} SET prize_pool = %s WHERE mode = %s", (remaining_pool, mode))
+                await archive_draw(cursor, engine, round_number, winning_numbers, prize_pool, len(winners), payout)
+                await cursor.execute(f'''
+                    UPDATE {TABLE_DRAWS}
+                    SET draw_number = draw_number + 1, next_draw_time = %s
+                    WHERE mode = %s
+                ''', (next_draw_time, mode))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+    metrics.inc("solttery_draws_total", mode=mode)
+    metrics.inc("solttery_draw_entries_total", engine.entry_count, mode=mode)
+    metrics.inc("solttery_draw_winners_total", len(winners), mode=mode)
+    engine.reset(round_number + 1)
+    invalidate_round_state(mode)
+    stats_cache.pop(mode, None)
+    notify_draw(mode, round_number, winning_numbers, winners, payout)
+    return next_draw_time
 
-def main():
-    application = Application.builder().token(TOKEN).build()
+def notify_draw(mode, round_number, winning_numbers, winners, payout):
+    numbers = ', '.join(map(str, winning_numbers))
+    tickets = collections.Counter(user_id for user_id, _ in winners if user_id)
+    for user_id, count in tickets.items():
+        outbound.send(
+            user_id,
+            f"🎉 You won {mode.capitalize()} draw #{round_number}!\n"
+            f"Winning numbers: {numbers}\n"
+            f"Winning tickets: {count}\n"
+            f"Prize: {count * payout:.3f} SOLTTERY",
+            priority=SEND_PRIORITY_WINNER
+        )
+    if CHANNELID:
+        outbound.send(
+            CHANNELID,
+            f"🎰 {mode.capitalize()} draw #{round_number}\n"
+            f"Winning numbers: {numbers}\n"
+            + (f"Winners: {len(winners)}\nPrize per ticket: {payout:.3f} SOLTTERY" if winners else "No winners - the prize pool rolls over!")
+        )
+
+async def archive_draw(cursor, engine, round_number, winning_numbers, prize_pool, winner_count, payout):
+    mode = engine.mode
+    await cursor.execute(f'''
+        INSERT INTO {TABLE_RESULTS} (mode, round, winning_combo, entry_count, winner_count, prize_pool, payout_per_winner)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ''', (mode, round_number, combo_key(winning_numbers), engine.entry_count, winner_count, prize_pool, payout))
+    played = {}
+    combos = []
+    for rank, count in engine.counts.items():
+        numbers = engine.unrank(rank)
+        combos.append((mode, combo_key(numbers), count))
+        for number in numbers:
+            played[number] = played.get(number, 0) + count
+    drawn = set(winning_numbers)
+    await cursor.executemany(f'''
+        INSERT INTO {TABLE_NUMBER_STATS} (mode, number, times_drawn, times_played)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE times_drawn = times_drawn + VALUES(times_drawn), times_played = times_played + VALUES(times_played)
+    ''', [(mode, number, int(number in drawn), played.get(number, 0)) for number in drawn | played.keys()])
+    if combos:
+        await cursor.executemany(f'''
+            INSERT INTO {TABLE_COMBO_STATS} (mode, combo, times_played)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE times_played = times_played + VALUES(times_played)
+        ''', combos)
+
+async def load_stats_text(mode):
+    async with db_cursor() as cursor:
+        await cursor.execute(f"SELECT number, times_drawn, times_played FROM {TABLE_NUMBER_STATS} WHERE mode = %s", (mode,))
+        numbers = sorted(await cursor.fetchall(), key=lambda row: (-row[1], row[0]))
+        await cursor.execute(f'''
+            SELECT combo, times_played FROM {TABLE_COMBO_STATS}
+            WHERE mode = %s ORDER BY times_played DESC LIMIT 5
+        ''', (mode,))
+        combos = await cursor.fetchall()
+        await cursor.execute(f'''
+            SELECT round, winning_combo, winner_count, payout_per_winner FROM {TABLE_RESULTS}
+            WHERE mode = %s ORDER BY round DESC LIMIT 5
+        ''', (mode,))
+        results = await cursor.fetchall()
+    lines = [f"📊 *{mode.capitalize()} Stats*", ""]
+    if numbers:
+        lines.append("🔥 *Hot:* " + ", ".join(f"{number} ({drawn}x)" for number, drawn, _ in numbers[:5]))
+        lines.append("🧊 *Cold:* " + ", ".join(f"{number} ({drawn}x)" for number, drawn, _ in numbers[:-6:-1]))
+        popular = sorted(numbers, key=lambda row: (-row[2], row[0]))[:5]
+        lines.append("🎟 *Most played numbers:* " + ", ".join(f"{number} ({played})" for number, _, played in popular))
+    if combos:
+        lines.append("🎯 *Most played combos:* " + "; ".join(f"{combo.replace(',', ', ')} ({played})" for combo, played in combos))
+    if results:
+        lines.append("")
+        lines.append("🏆 *Recent draws:*")
+        for round_number, winning_combo, winner_count, payout in results:
+            lines.append(f"#{round_number}: {winning_combo.replace(',', ', ')} - {winner_count} winner(s), {round(payout)} SOLTTERY each")
+    return "\n".join(lines)
+
+async def get_stats_text(mode):
+    cached = stats_cache.get(mode)
+    if cached is None or time.monotonic() - cached["loaded_at"] > STATS_CACHE_TTL:
+        cached = stats_cache[mode] = {"text": await load_stats_text(mode), "loaded_at": time.monotonic()}
+    return cached["text"]
+
+async def monitor_lottery():
+    schedule = []
+    for mode in GAME_MODES:
+        draw_info = await load_draw_info(mode)
+        next_draw_time = draw_info["next_draw_time"]
+        if next_draw_time is None:
+            next_draw_time = next_draw_boundary(time.time())
+            await save_draw_info(mode, draw_info["draw_number"], next_draw_time)
+        await load_draw_engine(mode)
+        heapq.heappush(schedule, (next_draw_time, mode))
+    while schedule and not lottery_stop.is_set():
+        next_draw_time, mode = schedule[0]
+        delay = next_draw_time - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(lottery_stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        heapq.heappop(schedule)
+        try:
+            with metrics.timer("solttery_draw_duration_seconds", mode=mode):
+                next_draw_time = await draw_lottery(mode)
+        except Exception:
+            logging.exception("Draw failed for mode %s", mode)
+            metrics.inc("solttery_draw_failures_total", mode=mode)
+            next_draw_time = time.time() + DRAW_RETRY_DELAY
+        heapq.heappush(schedule, (next_draw_time, mode))
+
+async def lead_draws(cursor):
+    global is_draw_leader
+    logging.info("Acquired draw leadership")
+    is_draw_leader = True
+    scheduler = asyncio.create_task(monitor_lottery())
+    try:
+        while not scheduler.done():
+            await asyncio.wait([scheduler], timeout=LEADER_CHECK_INTERVAL)
+            await cursor.execute("SELECT IS_USED_LOCK(%s) = CONNECTION_ID()", (LEADER_LOCK_NAME,))
+            if not (await cursor.fetchone())[0]:
+                logging.error("Lost draw leadership")
+                return
+        scheduler.result()
+    finally:
+        if not scheduler.done():
+            scheduler.cancel()
+            await asyncio.gather(scheduler, return_exceptions=True)
+        is_draw_leader = False
+        release_draw_engines()
+
+async def run_draw_leader():
+    while not lottery_stop.is_set():
+        conn = None
+        try:
+            conn = await aiomysql.connect(host=DB_HOST, user=DB_USER, password=DB_PASSWORD, db=DB_NAME, autocommit=True)
+            async with conn.cursor() as cursor:
+                while not lottery_stop.is_set():
+                    await cursor.execute("SELECT GET_LOCK(%s, %s)", (LEADER_LOCK_NAME, LEADER_CHECK_INTERVAL))
+                    if (await cursor.fetchone())[0] == 1:
+                        await lead_draws(cursor)
+                        break
+        except Exception:
+            logging.exception("Draw leader failed")
+            try:
+                await asyncio.wait_for(lottery_stop.wait(), timeout=LEADER_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            if conn is not None:
+                conn.close()
+
+async def serve_metrics(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+        if request.split()[1:2] == [b"/metrics"]:
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    global metrics_server
+    metrics.gauge_group("solttery_dispatch", dispatcher.get_stats)
+    metrics.gauge_group("solttery_db_pool", get_db_pool_stats)
+    metrics.gauge_group("solttery_send", outbound.get_stats)
+    for mode, engine in draw_engines.items():
+        metrics.gauge("solttery_round_entries", lambda engine=engine: engine.entry_count, mode=mode)
+    metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+        metrics_server = None
+
+async def on_startup(application: Application):
+    if not KMS_KEY_ID:
+        raise RuntimeError("KMS_KEY_ID is not set; wallet keys cannot be encrypted")
+    await setup_database()
+    await init_db_pool()
+    if METRICS_PORT:
+        await start_metrics_server()
+    lottery_stop.clear()
+    lottery_tasks.append(asyncio.create_task(run_draw_leader()))
+    wallet_tasks.append(asyncio.create_task(run_wallet_pool()))
+    outbound.start(application.bot)
+    dispatcher.ready.set()
+
+async def on_stop(application: Application):
+    await dispatcher.drain()
+    lottery_stop.set()
+    if lottery_tasks:
+        _, pending = await asyncio.wait(lottery_tasks, timeout=DRAW_SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*lottery_tasks, return_exceptions=True)
+    lottery_tasks.clear()
+    await outbound.stop()
+    for task in wallet_tasks:
+        task.cancel()
+    await asyncio.gather(*wallet_tasks, return_exceptions=True)
+    wallet_tasks.clear()
+
+async def on_shutdown(application: Application):
+    await stop_metrics_server()
+    await close_db_pool()
+
+def build_application(request=None):
+    builder = Application.builder().token(TOKEN).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    if request is not None:
+        builder = builder.request(request)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+    if BOT_MODE == 'webhook':
+        builder = builder.concurrent_updates(WEBHOOK_CONCURRENCY)
+    application = builder.build()
     application.add_handler(CommandHandler("start", create_start_task))
+    application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CallbackQueryHandler(button))
-    threading.Thread(target=async_init, daemon=True).start()
-    application.run_polling()
+    return application
 
-def async_init():
-    asyncio.run(setup_database())
+def main():
+    application = build_application()
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN:
+            raise RuntimeError("WEBHOOK_URL and WEBHOOK_SECRET_TOKEN must be set when BOT_MODE=webhook")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY]
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file